@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# MZP tile conversion benchmark
+# comes with ABSOLUTELY NO WARRANTY.
+#
+# Measures the per-tile pixel conversions of _extract_mzp_tiles (4bpp nibble
+# expansion, 16bpp + offset (+ alpha) true colour) over synthetic tiles, with
+# NumPy when it is installed and with the lookup table fallback, whatever the
+# tile size (the library picks NumPy from a pixel count up, see the
+# NUMPY_*_MIN_PIXELS thresholds). Every result is checked against a per-pixel
+# reference conversion.
+#
+# Small tiles are the 4bpp fonts and UI sheets case: many files, little data
+# each, so the fixed cost per tile matters as much as the throughput.
+
+import sys
+import random
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath('tools')))
+import _extract_mzp_tiles as tiles  # noqa: E402
+from corpus import indexed_tile, truecolor_tile, SEED  # noqa: E402
+from bench_mzx import timeit  # noqa: E402
+
+SAMPLES = ['tile4', 'tile24', 'tile32']
+
+
+def reference_4bpp(data):
+    return bytes(value for octet in data for value in (octet & 0x0F, octet >> 4))
+
+
+def reference_truecolor(data, tile_size, alpha):
+    pixels = bytearray()
+    for index in range(tile_size):
+        p, q = data[index * 2], data[index * 2 + 1]
+        offset = data[tile_size * 2 + index]
+        pixels += bytes(((q & 0xf8) + (offset >> 5),
+                         ((q & 0x07) << 5 | (p & 0xe0) >> 3) + ((offset & 0x1f) >> 3),
+                         ((p & 0x1f) << 3) + (offset & 0x7)))
+        if alpha:
+            pixels.append(data[tile_size * 3 + index])
+    return bytes(pixels)
+
+
+def make_samples(width, height, seed=SEED):
+    rnd = random.Random(seed)
+    tile_size = width * height
+    return {
+        'tile4': (indexed_tile(4, rnd, width, height), lambda d: tiles.expand_4bpp(d), reference_4bpp),
+        'tile24': (truecolor_tile(False, rnd, width, height), lambda d: tiles.convert_truecolor(d, tile_size, False),
+                   lambda d: reference_truecolor(d, tile_size, False)),
+        'tile32': (truecolor_tile(True, rnd, width, height), lambda d: tiles.convert_truecolor(d, tile_size, True),
+                   lambda d: reference_truecolor(d, tile_size, True)),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the MZP tile conversions')
+    parser.add_argument('-W', '--width', default=0x40, type=int, help='Tile width (default: 64)')
+    parser.add_argument('-H', '--height', default=0x40, type=int, help='Tile height (default: 64)')
+    parser.add_argument('-t', '--min-time', default=0.2, type=float, dest='min_time',
+                        help='Seconds spent per measure, the best run is kept (default: 0.2)')
+    parser.add_argument('-p', '--samples', nargs='+', default=SAMPLES, choices=SAMPLES,
+                        help='Tile types to measure (default: all)')
+    args = parser.parse_args()
+
+    samples = make_samples(args.width, args.height)
+    modes = ['tables'] + (['numpy'] if tiles.np is not None else [])
+    numpy = tiles.np
+
+    print('{0:<16} {1:>9} {2:>10} {3:>12} {4:>12}'.format('sample/mode', 'size', 'MB/s', 'us/tile', 'reference'))
+    for name in args.samples:
+        data, convert, reference = samples[name]
+        ref_took, expected = timeit(lambda: reference(data), args.min_time)
+        tiles.NUMPY_4BPP_MIN_PIXELS = tiles.NUMPY_TRUECOLOR_MIN_PIXELS = 0
+        for mode in modes:
+            tiles.np = numpy if mode == 'numpy' else None
+            took, result = timeit(lambda: convert(data), args.min_time)
+            if result != expected:
+                raise AssertionError('{0} conversion differs from the reference ({1})'.format(name, mode))
+            print('{0:<16} {1:>9} {2:>10.2f} {3:>12.1f} {4:>11.1f}x'.format(
+                name + '/' + mode, len(data), len(data) / took / 1e6, took * 1e6, ref_took / took))
+        tiles.np = numpy
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#
+# MZX codec benchmark and regression suite
+# comes with ABSOLUTELY NO WARRANTY.
+#
+# Measures throughput (MB/s of uncompressed data) and compression ratio of
+# every MZX codec path over the synthetic corpus, with and without xorff.
+# Every compressed stream is decoded back and compared to its input.
+#
+# Usage:
+#   python bench_mzx.py -o before.json
+#   (change the codec)
+#   python bench_mzx.py -o after.json -b before.json
+#
+# With --baseline the exit status is 1 when a path got slower than the
+# tolerance allows, or when any compression ratio got worse.
+
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath('tools')))
+from mzx.comp_mzx0 import compress, LEVEL_GREEDY  # noqa: E402
+from mzx.decomp_mzx0 import mzx0_decode, mzx0_decompress, mzx0_decompress_iter  # noqa: E402
+from corpus import make_corpus, SEED  # noqa: E402
+
+COMPRESS_PATHS = ['compress-L0', 'compress-L1', 'compress-L2', 'compress-L3']
+DECOMPRESS_PATHS = ['decode', 'decompress', 'stream']
+PATHS = COMPRESS_PATHS + DECOMPRESS_PATHS
+
+
+def timeit(func, min_time):
+    """Run func until min_time seconds have passed (at least once), return (best time, last result)."""
+    best = None
+    spent = 0.0
+    while True:
+        start = time.perf_counter()
+        result = func()
+        took = time.perf_counter() - start
+        best = took if best is None else min(best, took)
+        spent += took
+        if spent >= min_time:
+            return best, result
+
+
+def bench_sample(sample, xorff, paths, min_time):
+    data = sample.data
+    results = {}
+    for path in paths:
+        if path not in COMPRESS_PATHS:
+            continue
+        level = int(path[-1])
+        took, out = timeit(lambda: compress(data, xorff, level), min_time)
+        status, dec = mzx0_decode(memoryview(out)[8:], len(data), xorff)
+        if dec != data:
+            raise AssertionError('{0} does not round-trip on {1}'.format(path, sample.name))
+        results[path] = {'mb_s': len(data) / took / 1e6, 'ratio': len(out) / len(data), 'out': len(out)}
+
+    stream = bytes(compress(data, xorff, LEVEL_GREEDY)[8:])
+    decoders = {
+        'decode': lambda: mzx0_decode(stream, len(data), xorff)[1],
+        'decompress': lambda: mzx0_decompress(io.BytesIO(stream), len(stream), len(data), xorff)[1].read(),
+        'stream': lambda: b''.join(mzx0_decompress_iter(io.BytesIO(stream), len(stream), len(data), xorff)),
+    }
+    for path in paths:
+        if path not in DECOMPRESS_PATHS:
+            continue
+        took, dec = timeit(decoders[path], min_time)
+        if dec != data:
+            raise AssertionError('{0} does not decode {1}'.format(path, sample.name))
+        results[path] = {'mb_s': len(data) / took / 1e6}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print the per-key changes against a baseline, return the list of regressions."""
+    regressions = []
+    print('\n{0:<32} {1:>10} {2:>10} {3:>8} {4:>9}'.format('baseline comparison', 'MB/s was', 'MB/s now',
+                                                           'speed', 'ratio'))
+    for key, now in results.items():
+        was = baseline.get(key)
+        if was is None:
+            continue
+        speed = now['mb_s'] / was['mb_s'] - 1.0
+        ratio = now['ratio'] - was['ratio'] if 'ratio' in now and 'ratio' in was else 0.0
+        flags = []
+        if speed < -tolerance:
+            flags.append('SLOWER')
+        if ratio > 1e-9:
+            flags.append('LARGER')
+        print('{0:<32} {1:>10.2f} {2:>10.2f} {3:>+7.1%} {4:>+9.4f} {5}'.format(
+            key, was['mb_s'], now['mb_s'], speed, ratio, ' '.join(flags)))
+        if flags:
+            regressions.append(key)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the MZX codecs over a synthetic corpus')
+    parser.add_argument('-s', '--scale', default=1, type=int, help='Corpus size multiplier (default: 1)')
+    parser.add_argument('-t', '--min-time', default=0.2, type=float, dest='min_time',
+                        help='Seconds spent per measure, the best run is kept (default: 0.2)')
+    parser.add_argument('-p', '--paths', nargs='+', default=PATHS, choices=PATHS,
+                        help='Codec paths to measure (default: all)')
+    parser.add_argument('-o', '--output', default=None, help='Write results as JSON')
+    parser.add_argument('-b', '--baseline', default=None, help='Compare against a JSON result file')
+    parser.add_argument('--tolerance', default=0.15, type=float,
+                        help='Allowed throughput loss against the baseline (default: 0.15)')
+    return parser.parse_args()
+
+
+############
+# __main__ #
+############
+
+if __name__ == '__main__':
+    args = parse_args()
+    corpus = make_corpus(args.scale)
+
+    results = {}
+    print('{0:<32} {1:>9} {2:>10} {3:>8}'.format('sample/path/mode', 'size', 'MB/s', 'ratio'))
+    for sample in corpus:
+        for xorff in (False, True):
+            mode = 'xorff' if xorff else 'plain'
+            for path, result in bench_sample(sample, xorff, args.paths, args.min_time).items():
+                key = '{0}/{1}/{2}'.format(sample.name, path, mode)
+                results[key] = result
+                ratio = '{0:>7.1%}'.format(result['ratio']) if 'ratio' in result else ''
+                print('{0:<32} {1:>9} {2:>10.2f} {3:>8}'.format(key, len(sample.data), result['mb_s'], ratio))
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline, 'rt') as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        print('Regressions = {0}'.format(len(regressions)))
+
+    if args.output is not None:
+        report = {
+            'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                     'scale': args.scale, 'seed': SEED},
+            'results': results,
+            'regressions': regressions,
+        }
+        with open(args.output, 'wt') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print('Results: {0}'.format(args.output))
+
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+# MZX xorff key microbenchmark
+# comes with ABSOLUTELY NO WARRANTY.
+#
+# Incompressible input turns into literal runs only, which is where the
+# XOR-with-0xFF key of script .MZX is applied. Compares the plain and xorff
+# throughput of the literal paths of both codecs. The key has to touch every
+# literal byte once, so xorff is allowed the time of one bytes.translate pass
+# over the input on top of plain; the exit status is 1 when it is slower than
+# that by more than the tolerance.
+
+import sys
+import random
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath('tools')))
+from mzx import XORFF_TABLE  # noqa: E402
+from mzx.comp_mzx0 import compress, LEVEL_STORE  # noqa: E402
+from mzx.decomp_mzx0 import mzx0_decode  # noqa: E402
+from bench_mzx import timeit  # noqa: E402
+
+
+def bench(data, min_time):
+    """Best throughput of each path with either key and of the key pass alone, the runs of a path
+    are interleaved to share machine noise."""
+    streams = {xorff: compress(data, xorff, LEVEL_STORE)[8:] for xorff in (False, True)}
+    for xorff, stream in streams.items():
+        if mzx0_decode(stream, len(data), xorff)[1] != data:
+            raise AssertionError('literal stream does not round-trip (xorff={0})'.format(xorff))
+    paths = {
+        'compress': lambda xorff: compress(data, xorff, LEVEL_STORE),
+        'decode': lambda xorff: mzx0_decode(streams[xorff], len(data), xorff),
+    }
+    runs = {
+        'plain': lambda func: func(False),
+        'xorff': lambda func: func(True),
+        'key': lambda func: data.translate(XORFF_TABLE),
+    }
+
+    results = {}
+    for path, func in paths.items():
+        best = dict.fromkeys(runs)
+        spent = 0.0
+        while spent < min_time:
+            for run, call in runs.items():
+                took, _ = timeit(lambda: call(func), 0)
+                best[run] = took if best[run] is None else min(best[run], took)
+                spent += took
+        for run, took in best.items():
+            results[path, run] = len(data) / took / 1e6
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare plain and xorff literal throughput')
+    parser.add_argument('-n', '--size', default=0x100000, type=int, help='Input size in bytes (default: 1 MiB)')
+    parser.add_argument('-t', '--min-time', default=0.5, type=float, dest='min_time',
+                        help='Seconds spent per measure, the best run is kept (default: 0.5)')
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help='Allowed xorff throughput loss against plain plus one key pass (default: 0.1)')
+    args = parser.parse_args()
+
+    data = random.Random(0xFF).randbytes(args.size)
+    results = bench(data, args.min_time)
+
+    slower = 0
+    print('{0:<10} {1:>10} {2:>10} {3:>10} {4:>8} {5:>8}'.format('path', 'plain', 'xorff', 'key', 'xorff', 'over key'))
+    for path in ('compress', 'decode'):
+        plain, xorff, key = results[path, 'plain'], results[path, 'xorff'], results[path, 'key']
+        # throughput plain would have with one more translate pass over the input
+        bound = 1.0 / (1.0 / plain + 1.0 / key)
+        print('{0:<10} {1:>10.2f} {2:>10.2f} {3:>10.2f} {4:>+7.1%} {5:>+7.1%}'.format(
+            path, plain, xorff, key, xorff / plain - 1.0, xorff / bound - 1.0))
+        if xorff < bound * (1.0 - args.tolerance):
+            slower += 1
+    sys.exit(1 if slower else 0)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# Synthetic MZX benchmark corpus
+# comes with ABSOLUTELY NO WARRANTY.
+#
+# Deterministic samples shaped like the data the toolkit handles, so the
+# codecs can be measured without any game data:
+# - CP932 scripts, instructions separated by ';' (allpac *.MZX, xorff)
+# - 4bpp / 8bpp indexed tiles (MZP bmp_type 0x01)
+# - 16bpp + offset (+ alpha) true-colour tiles (MZP bmp_type 0x08 / 0x0B)
+
+import random
+from collections import namedtuple
+
+Sample = namedtuple('Sample', 'name data')
+
+SEED = 0x4D5A58
+TILE_WIDTH = 0x100
+TILE_HEIGHT = 0x80
+
+_SPEECH = ['　「{0}、今日は{1}へ行こう」', '　{0}はため息をついた。', '　……{1}の空は、まだ{2}かった。',
+           '　「{0}！」', '　{0}の声が{1}に響く。']
+_NAMES = ['士郎', 'セイバー', '凛', '桜', 'アーチャー', '薫']
+_PLACES = ['学校', '教会', '橋', '屋敷', '公園']
+_ADJECTIVES = ['青', '赤', '暗', '明る', '白']
+
+
+def script_sample(size, rnd):
+    """CP932 text made of _ZM text lines and engine commands."""
+    instrs = []
+    total = 0
+    index = 0
+    while total < size:
+        if index % 5 == 0:
+            instr = '_MSAD({0},{1})'.format(rnd.randrange(200), rnd.randrange(4))
+        elif index % 11 == 0:
+            instr = '_STTI({0})'.format(rnd.choice(_PLACES))
+        elif index % 7 == 0:
+            instr = '_LVSV({0:03d},{1})'.format(rnd.randrange(1000), rnd.randrange(2))
+        else:
+            line = rnd.choice(_SPEECH).format(rnd.choice(_NAMES), rnd.choice(_PLACES), rnd.choice(_ADJECTIVES))
+            instr = '_ZM{0:05d}({1}{2})'.format(rnd.randrange(100000), line, '_r' if index % 2 else '@n')
+        instr = instr.encode('cp932')
+        instrs.append(instr)
+        total += len(instr) + 1
+        index += 1
+    return b';'.join(instrs)[:size]
+
+
+def _gradient(x, y, phase):
+    return (x * 3 + y * 2 + phase) & 0xFF
+
+
+def indexed_tile(bpp, rnd, width=TILE_WIDTH, height=TILE_HEIGHT):
+    """Palette indices as stored in MZX tiles, 4bpp packs two pixels per byte (low nibble first)."""
+    colors = 1 << bpp
+    phase = rnd.randrange(256)
+    pixels = []
+    for y in range(height):
+        for x in range(width):
+            if bpp == 4:  # font / UI sheet: mostly transparent with glyph strokes
+                value = rnd.randrange(1, colors) if (x // 3 + y // 4 + phase) % 7 == 0 else 0
+            else:  # painted background: smooth ramps with dithering noise
+                value = (_gradient(x, y, phase) // 6 + (rnd.random() < 0.1) * rnd.randrange(3)) % colors
+            pixels.append(value)
+    if bpp == 4:
+        return bytes(pixels[i] | (pixels[i + 1] << 4) for i in range(0, len(pixels), 2))
+    return bytes(pixels)
+
+
+def truecolor_tile(alpha, rnd, width=TILE_WIDTH, height=TILE_HEIGHT):
+    """RGB565-like plane, 3-3-2 offset plane and optional alpha plane, like bmp_type 0x08 / 0x0B."""
+    phase = rnd.randrange(256)
+    plane16 = bytearray()
+    offsets = bytearray()
+    alphas = bytearray()
+    for y in range(height):
+        for x in range(width):
+            r = _gradient(x, y, phase)
+            g = _gradient(y, x, phase * 2)
+            b = (r + g + rnd.randrange(4)) & 0xFF
+            word = ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
+            plane16 += word.to_bytes(2, 'little')
+            offsets.append(((r & 0x07) << 5) | ((g & 0x03) << 3) | (b & 0x07))
+            alphas.append(0xFF if (x + y) % 97 else 0x80)
+    return bytes(plane16 + offsets + (alphas if alpha else b''))
+
+
+def make_corpus(scale=1, seed=SEED):
+    """Return the benchmark samples, scale multiplies the sample sizes."""
+    rnd = random.Random(seed)
+    height = TILE_HEIGHT * scale
+    return [
+        Sample('script', script_sample(0x18000 * scale, rnd)),
+        Sample('tile4', indexed_tile(4, rnd, height=height)),
+        Sample('tile8', indexed_tile(8, rnd, height=height)),
+        Sample('tile24', truecolor_tile(False, rnd, height=height // 2)),
+        Sample('tile32', truecolor_tile(True, rnd, height=height // 2)),
+    ]
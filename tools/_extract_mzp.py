@@ -9,15 +9,21 @@
 # MZP image files extraction utility
 # For more information, see Specifications/mzp_format.md
 
+import os
 import struct
 import sys
+import time
 import logging
 import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from struct import unpack
 from mzx.decomp_mzx0 import mzx0_decompress
 from _extract_mzp_tiles import MzpFile
 
+ExtractResult = namedtuple('ExtractResult', 'file status detail elapsed error')
+
 
 class ArchiveEntry:
     def __init__(self, sector_offset, offset, sector_size_upper_boundary, size, number_of_entries):
@@ -42,6 +48,10 @@ def parse_args():
     parser.add_argument('-i', '--ignore_extracted',
                         action='store_true', dest='ignore_extracted',
                         help='do not extract MZP that already extracted')
+    parser.add_argument('-j', '--jobs',
+                        default=1, dest='jobs', type=int,
+                        help='Number of worker processes, 0 for one per CPU; a single MZP is split by tiles '
+                             '(default: 1)')
     parser.add_argument('input', metavar='input.mzp', help='input .mzp file')
 
     return parser, parser.parse_args()
@@ -58,21 +68,69 @@ def extract_check(args):
         sys.exit(20)
 
     if file_path.is_file():
-        extract_verb(args, file_path)
+        files = [file_path]
+    else:
+        files = sorted(file for file in file_path.glob('**/*') if file.suffix == '.MZP')
+
+    start = time.perf_counter()
+    counts = {'OK': 0, 'ERR': 0, 'SKIP': 0}
+    busy = 0.0
+    for result in extract_files(args, files):
+        counts[result.status] += 1
+        busy += result.elapsed
+        if result.status == 'OK':
+            print('* {0} => {1} [{2:.0f}ms]'.format(result.file.name, result.detail, result.elapsed * 1000))
+        elif result.status == 'ERR':
+            print('* {0} [FAILED]'.format(result.file.name))
+            print('ERR: {0} failed to extract "{1}" - {2}'.format(result.detail, result.file, result.error),
+                  file=sys.stderr)
+    print('Extracted = {0}\nFailed = {1}\nSkipped = {2}'.format(counts['OK'], counts['ERR'], counts['SKIP']))
+    print('Elapsed {0:.2f}s ({1:.2f}s of extraction, {2} job(s))'.format(
+        time.perf_counter() - start, busy, jobs_count(args)))
+    return counts['ERR']
+
+
+def jobs_count(args):
+    return args.jobs or os.cpu_count() or 1
+
+
+def quiet_worker():
+    # results are printed in file order by the parent
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def extract_files(args, files):
+    """Yield the result of every file in files order, worked out by args.jobs processes."""
+    jobs = jobs_count(args)
+    if jobs > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=quiet_worker) as executor:
+            yield from executor.map(extract_file, [args] * len(files), files)
+    elif jobs > 1 and files and not args.bin:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            yield extract_file(args, files[0], executor)
     else:
-        for file in file_path.glob('**/*'):
-            if file.suffix == '.MZP':
-                extract_verb(args, file)
+        for file in files:
+            yield extract_file(args, file)
+
+
+def extract_file(args, file: Path, executor=None):
+    start = time.perf_counter()
+    try:
+        detail = extract_verb(args, file, executor)
+        status = 'SKIP' if detail is None else 'OK'
+        return ExtractResult(file, status, detail, time.perf_counter() - start, None)
+    except (Exception, SystemExit) as exc:
+        return ExtractResult(file, 'ERR', '[{0}]'.format(type(exc).__name__), time.perf_counter() - start, str(exc))
 
 
-def extract_verb(args, file: Path):
+def extract_verb(args, file: Path, executor=None):
     if args.ignore_extracted and file.with_suffix('.png').exists():
-        return
+        return None
 
     with file.open('rb') as input_file:
         header = input_file.read(6)
         if header != b'mrgd00':
-            return
+            return None
 
         logging.info('Extracting from ' + file.name)
         logging.debug('header: {0}'.format(header.decode('ASCII')))
@@ -80,7 +138,7 @@ def extract_verb(args, file: Path):
         number_of_entries, = struct.unpack('<H', input_file.read(2))
         logging.debug('found {0} entries'.format(number_of_entries))
         if not number_of_entries:
-            return
+            return None
 
         entries_descriptors = []
         for i in range(number_of_entries):
@@ -90,8 +148,11 @@ def extract_verb(args, file: Path):
 
         if args.bin:
             extract_bin(file, input_file, entries_descriptors, args.notmzx)
+            return '{0} entries'.format(number_of_entries)
         else:
-            MzpFile(file, input_file, entries_descriptors)
+            mzp = MzpFile(file, input_file, entries_descriptors, executor)
+            return '{0}: {1}x{2}, {3} tiles'.format(
+                file.with_suffix('.png').name, mzp.canvas_width, mzp.canvas_height, mzp.tile_count)
 
 
 def extract_bin(file: Path, input_file, entries_descriptors, not_mzx):
@@ -136,8 +197,8 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG, format='%(levelname)s: %(message)s')
     parser, args = parse_args()
     if args.input is not None:
-        extract_check(args)
+        nfailed = extract_check(args)
     else:
         parser.print_usage()
         sys.exit(20)
-    sys.exit(0)
+    sys.exit(1 if nfailed else 0)
@@ -23,26 +23,19 @@
 import sys
 import zlib
 import logging
+from itertools import repeat
 from pathlib import Path
 from struct import unpack, pack
 from subprocess import call
-from mzx.decomp_mzx0 import mzx0_decompress
+from mzx.decomp_mzx0 import mzx0_decode
+from mzputil import byte_table, or_planes
 
-logger = logging.Logger('MZP')
-
-
-# http://blog.flip-edesign.com/?p=23
-class Byte(object):
-    def __init__(self, number):
-        self.number = number
+try:
+    import numpy as np
+except ImportError:  # optional, tile conversions fall back to the lookup tables below
+    np = None
 
-    @property
-    def high(self):
-        return self.number >> 4
-
-    @property
-    def low(self):
-        return self.number & 0x0F
+logger = logging.Logger('MZP')
 
 
 def write_pngsig(f):
@@ -90,21 +83,21 @@ def write_trns(f, transparencydata):
     write_pngchunk_withcrc(f, b"tRNS", transparencydata)
 
 
-def write_idat(f, pixels):
-    write_pngchunk_withcrc(f, b"IDAT", zlib.compress(pixels))
+def write_idat(f, bands):
+    """ Compress the filtered scanlines into IDAT chunks as the bands come in.
+    """
+    compressor = zlib.compressobj()
+    for band in bands:
+        data = compressor.compress(band)
+        if data:
+            write_pngchunk_withcrc(f, b"IDAT", data)
+    write_pngchunk_withcrc(f, b"IDAT", compressor.flush())
 
 
 def write_iend(f):
     write_pngchunk_withcrc(f, b"IEND", b"")
 
 
-def chunks(l, n):
-    """ Yield successive n-sized chunks from l.
-    """
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
-
-
 ###############################################
 # struct TGAHeader
 # {
@@ -123,15 +116,89 @@ def chunks(l, n):
 #           descriptor;         // Image attribute flags.
 # };
 
+# NumPy pays a fixed cost per call that the lookup tables beat on small tiles, it is only used from these
+# pixel counts up (crossovers measured with benchmarks/bench_mzp.py: about 90x90 for 4bpp, 32x32 for true colour)
+NUMPY_4BPP_MIN_PIXELS = 0x2000
+NUMPY_TRUECOLOR_MIN_PIXELS = 0x400
+
+# 4bpp: two pixels per byte, low nibble first
+LOW_NIBBLE = byte_table(lambda i: i & 0x0F)
+HIGH_NIBBLE = byte_table(lambda i: i >> 4)
+
+
+def expand_4bpp(dec_buf):
+    """One palette index per byte from a decompressed 4bpp tile."""
+    if np is not None and len(dec_buf) * 2 >= NUMPY_4BPP_MIN_PIXELS:
+        packed = np.frombuffer(dec_buf, np.uint8)
+        return np.stack((packed & 0x0F, packed >> 4), axis=1).tobytes()
+    pixels = bytearray(len(dec_buf) * 2)
+    pixels[0::2] = dec_buf.translate(LOW_NIBBLE)
+    pixels[1::2] = dec_buf.translate(HIGH_NIBBLE)
+    return bytes(pixels)
+
+
+# 16bpp plane (P, Q bytes) + offset plane to 24bpp, every channel is made of disjoint bit fields:
+# r = Q & 0xf8 | ofs >> 5, g = (Q & 0x07) << 5 | (P & 0xe0) >> 3 | (ofs & 0x1f) >> 3, b = (P & 0x1f) << 3 | ofs & 0x7
+R_FROM_Q = byte_table(lambda q: q & 0xf8)
+R_FROM_OFS = byte_table(lambda o: o >> 5)
+G_FROM_Q = byte_table(lambda q: (q & 0x07) << 5)
+G_FROM_P = byte_table(lambda p: (p & 0xe0) >> 3)
+G_FROM_OFS = byte_table(lambda o: (o & 0x1f) >> 3)
+B_FROM_P = byte_table(lambda p: (p & 0x1f) << 3)
+B_FROM_OFS = byte_table(lambda o: o & 0x7)
+
+
+def convert_truecolor(dec_buf, tile_size, alpha):
+    """RGB (or RGBA with alpha) pixels of a decompressed 0x08/0x0B tile, converted as whole planes."""
+    channels = 4 if alpha else 3
+    if np is not None and tile_size >= NUMPY_TRUECOLOR_MIN_PIXELS:
+        planes = np.frombuffer(dec_buf, np.uint8, tile_size * channels)
+        p, q = planes[0:tile_size * 2:2], planes[1:tile_size * 2:2]
+        ofs = planes[tile_size * 2:tile_size * 3]
+        pixels = np.empty((tile_size, channels), np.uint8)
+        pixels[:, 0] = (q & 0xf8) | (ofs >> 5)
+        pixels[:, 1] = ((q & 0x07) << 5) | ((p & 0xe0) >> 3) | ((ofs & 0x1f) >> 3)
+        pixels[:, 2] = ((p & 0x1f) << 3) | (ofs & 0x7)
+        if alpha:
+            pixels[:, 3] = planes[tile_size * 3:]
+        return pixels.tobytes()
+
+    p, q = dec_buf[0:tile_size * 2:2], dec_buf[1:tile_size * 2:2]
+    ofs = dec_buf[tile_size * 2:tile_size * 3]
+    planes = [or_planes(q.translate(R_FROM_Q), ofs.translate(R_FROM_OFS)),
+              or_planes(q.translate(G_FROM_Q), p.translate(G_FROM_P), ofs.translate(G_FROM_OFS)),
+              or_planes(p.translate(B_FROM_P), ofs.translate(B_FROM_OFS))]
+    if alpha:
+        planes.append(dec_buf[tile_size * 3:tile_size * 4])
+    pixels = bytearray(tile_size * channels)
+    for channel, plane in enumerate(planes):
+        pixels[channel::channels] = plane
+    return bytes(pixels)
+
+
+def decode_tile(data, exlen, bitmap_bpp, bmp_type, tile_size):
+    """Decompress a tile (MZX0 header excluded), 4bpp and true-colour tiles are converted to one pixel per
+    1/3/4 bytes. Module level so that tiles can be decoded in worker processes."""
+    status, dec_buf = mzx0_decode(data, exlen)
+    if bitmap_bpp == 4:
+        return expand_4bpp(dec_buf)
+
+    # RGB/RGBA true color for 0x08 and 0x0B bmp type
+    elif bitmap_bpp in [24, 32] and bmp_type in [0x08, 0x0B]:
+        return convert_truecolor(dec_buf, tile_size, bitmap_bpp == 32)
+    return dec_buf
+
+
 def is_indexed_bitmap(bmp_info):
     return bmp_info == 0x01
 
 
 class MzpFile:
-    def __init__(self, file: Path, data, entries_descriptors):
+    def __init__(self, file: Path, data, entries_descriptors, executor=None):
         self.file = file
         self.data = data
         self.entries_descriptors = entries_descriptors
+        self.executor = executor
         self.paletteblob = b''
         self.palettepng = b''
         self.transpng = b''
@@ -140,7 +207,7 @@ class MzpFile:
         if self.bytesprepx == 0:
             self.bytesprepx = 1
         self.debug_format()
-        self.rows = [b''] * (self.height - self.tile_y_count * self.tile_crop)
+        self.init_canvas()
         self.loop_data()
         self.output_png()
 
@@ -254,77 +321,79 @@ class MzpFile:
             height = self.height - self.tile_y_count * self.tile_crop * 2
             logger.debug('MZP Cropped Size: Width = %s, Height = %s' % (width, height))
 
-    def extract_tile(self, index):
+    def read_tile(self, index):
         entry = self.entries_descriptors[index]
         self.data.seek(entry.real_offset)
         sig, size = unpack('<LL', self.data.read(0x8))
-        status, dec_buf = mzx0_decompress(self.data, entry.real_size - 8, size)
-        dec_buf = dec_buf.read()
-        if self.bitmap_bpp == 4:
-            tile_data = b''
-            for octet in dec_buf:
-                the_byte = Byte(octet)
-                tile_data += pack('BB', the_byte.low, the_byte.high)
-            dec_buf = tile_data
-
-        # RGB/RGBA true color for 0x08 and 0x0B bmp type
-        elif self.bitmap_bpp in [24, 32] and self.bmp_type in [0x08, 0x0B]:
-            # 16bpp
-            tile_data = b''
-            for index in range(self.tile_size):
-                P = dec_buf[index * 2]
-                Q = dec_buf[(index * 2) + 1]
-                b = (P & 0x1f) << 3
-                g = (Q & 0x07) << 5 | (P & 0xe0) >> 3
-                r = (Q & 0xf8)
-
-                # Offset for 16bpp to 24bpp
-                offset_byte = dec_buf[self.tile_size * 2 + index]
-                r_offset = offset_byte >> 5
-                g_offset = (offset_byte & 0x1f) >> 3
-                b_offset = offset_byte & 0x7
-
-                # Alpha
-                if self.bitmap_bpp == 32:
-                    a = dec_buf[self.tile_size * 3 + index]
-                    tile_data += pack('BBBB', r + r_offset, g + g_offset, b + b_offset, a)
-                else:
-                    tile_data += pack('BBB', r + r_offset, g + g_offset, b + b_offset)
-            dec_buf = tile_data
-        return dec_buf
+        return self.data.read(entry.real_size - 8), size
+
+    def extract_tile(self, index):
+        data, size = self.read_tile(index)
+        return decode_tile(data, size, self.bitmap_bpp, self.bmp_type, self.tile_size)
+
+    def init_canvas(self):
+        self.canvas_width = self.width - self.tile_x_count * self.tile_crop * 2
+        self.canvas_height = self.height - self.tile_y_count * self.tile_crop * 2
+        self.stride = self.canvas_width * self.bytesprepx
+        self.canvas = bytearray(self.stride * self.canvas_height)
+        # 切边后每块的宽高, 以及每行在解压后 tile 中的起点
+        self.cropped_width = self.tile_width - self.tile_crop * 2
+        self.cropped_height = self.tile_height - self.tile_crop * 2
+        self.tile_row_offsets = [((i + self.tile_crop) * self.tile_width + self.tile_crop) * self.bytesprepx
+                                 for i in range(self.cropped_height)]
 
     def loop_data(self):
-        for y in range(self.tile_y_count):
-            start_row = y * (self.tile_height - self.tile_crop * 2)  # 上下切边
-            rowcount = min(self.height, start_row + self.tile_height) - start_row - self.tile_crop * 2  # 共几行
-            self.loop_x(y, start_row, rowcount)
-
-    def loop_x(self, y, start_row, rowcount):
-        # Tile 块处理
-        for x in range(self.tile_x_count):
-            dec_buf = self.extract_tile(self.tile_x_count * y + x)
-
-            for i, tile_row_px in enumerate(chunks(dec_buf, self.tile_width * self.bytesprepx)):
-                if i < self.tile_crop:
-                    continue
-                if (i - self.tile_crop) >= rowcount:
-                    break
-                cur_width = len(self.rows[start_row + i - self.tile_crop])
-                px_count = min(self.width, cur_width + self.tile_width) * self.bytesprepx - cur_width
-                try:
-                    temp_row = tile_row_px[:px_count]
-                    self.rows[start_row + i - self.tile_crop] += temp_row[self.tile_crop * self.bytesprepx: len(
-                        temp_row) - self.tile_crop * self.bytesprepx]
-                except IndexError:
-                    logger.error(start_row + i - self.tile_crop)
+        self.tile_count = self.tile_x_count * self.tile_y_count
+        if self.executor is None:
+            tiles = map(self.extract_tile, range(self.tile_count))
+        else:  # 子进程解压, 按顺序拼回
+            blocks, sizes = zip(*map(self.read_tile, range(self.tile_count))) if self.tile_count else ((), ())
+            tiles = self.executor.map(decode_tile, blocks, sizes, repeat(self.bitmap_bpp), repeat(self.bmp_type),
+                                      repeat(self.tile_size))
+        for index, dec_buf in enumerate(tiles):
+            self.place_tile(index, dec_buf)
+
+    def place_tile(self, index, dec_buf):
+        """ Copy the cropped rows of a decoded tile into the canvas.
+        """
+        y, x = divmod(index, self.tile_x_count)
+        left = x * self.cropped_width
+        top = y * self.cropped_height
+        row_size = min(self.cropped_width, self.canvas_width - left) * self.bytesprepx
+        rowcount = min(self.cropped_height, self.canvas_height - top)
+        if row_size <= 0 or rowcount <= 0:
+            return
+        tile_length = self.tile_size * self.bytesprepx
+        if len(dec_buf) < tile_length:
+            logger.error('Tile {0} is short by {1} bytes'.format(index, tile_length - len(dec_buf)))
+            dec_buf = bytes(dec_buf).ljust(tile_length, b'\0')
+
+        canvas = self.canvas
+        dst = top * self.stride + left * self.bytesprepx
+        for src in self.tile_row_offsets[:rowcount]:
+            canvas[dst:dst + row_size] = dec_buf[src:src + row_size]
+            dst += self.stride
+
+    def scanline_bands(self, band_size=0x40000):
+        """ Yield the canvas as filtered scanlines (filter type 0), about band_size bytes at a time.
+        """
+        canvas = memoryview(self.canvas)
+        rows_per_band = max(1, band_size // (self.stride + 1))
+        for first in range(0, self.canvas_height, rows_per_band):
+            band = bytearray()
+            for start in range(first * self.stride, min(first + rows_per_band, self.canvas_height) * self.stride,
+                               self.stride):
+                band += b'\x00'
+                band += canvas[start:start + self.stride]
+            yield band
 
     # 输出PNG
     def output_png(self):
         png_path = self.file.with_suffix('.png')
         with png_path.open('wb') as png:
             write_pngsig(png)
-            width = self.width - self.tile_x_count * self.tile_crop * 2
-            height = self.height - self.tile_y_count * self.tile_crop * 2
+            width = self.canvas_width
+            height = self.canvas_height
             if is_indexed_bitmap(self.bmp_type):
                 write_ihdr(png, width, height, 8, 3)  # 8bpp (PLTE)
                 write_plte(png, self.palettepng)
@@ -337,10 +406,6 @@ class MzpFile:
                 write_ihdr(png, width, height, 8, 6)  # 32bpp
 
             # split into rows and add png filtering info (mandatory even with no filter)
-            row_data = b''
-            for row in self.rows:
-                row_data += b'\x00' + row
-
-            write_idat(png, row_data)
+            write_idat(png, self.scanline_bands())
             write_iend(png)
     # call(["cmd", "/c", "start", pngoutpath])
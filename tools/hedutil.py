@@ -13,14 +13,23 @@ import os
 import errno
 import sys
 import argparse
+import mmap
+from bisect import bisect_left, insort
+from concurrent.futures import ThreadPoolExecutor
 from sys import stderr
-from struct import unpack, unpack_from, pack
+from struct import unpack, unpack_from, pack, iter_unpack, calcsize
+from array import array
 import re
 import glob
+import zlib
+import json
+import hashlib
+import sqlite3
 import yaml
 from pathlib import Path
 from collections import OrderedDict
 from base64 import b64encode
+from mzputil import mrgd00_entries
 
 
 class CustomException(Exception):
@@ -74,6 +83,25 @@ def represent_ordereddict(dumper, data):
     return node
 
 
+# libyaml-backed classes when PyYAML was built with it, filelists only hold plain types
+class FilelistLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+    pass
+
+
+class FilelistDumper(getattr(yaml, 'CSafeDumper', yaml.SafeDumper)):
+    pass
+
+
+def path_constructor(loader, node):
+    # older filelists stored the storage directory as a pathlib object
+    return str(Path(*loader.construct_sequence(node)))
+
+
+FilelistLoader.add_constructor(u'tag:yaml.org,2002:seq', ordereddict_constructor)
+for path_class in ('PosixPath', 'WindowsPath'):
+    FilelistLoader.add_constructor(u'tag:yaml.org,2002:python/object/apply:pathlib.' + path_class, path_constructor)
+FilelistDumper.add_representer(OrderedDict, represent_ordereddict)
+
 LINE_WIDTH = 88
 
 
@@ -105,52 +133,244 @@ class HedEntry:
                 'HedEntry constructor expects either a 4-byte or 8-byte binary block, source file may be incomplete')
 
     def to_block(self, blocksize):
+        ofs_aligned = self.offset // 0x800
+        if ofs_aligned > 0xFFFFF:
+            raise ValueError('offset {0:08X} of {1} is out of the .hed range'.format(self.offset, self.name))
         if blocksize == 8:
-            ofs_aligned = self.offset // 0x800
             ofs_low = ofs_aligned & 0xFFFF
             ofs_high = (ofs_aligned & 0xF0000) >> 4
             size_low = self.size & 0xFFFF
-            if size_low == 0:
-                size_sect = self.size // 0x800
-            else:
-                size_sect = self.size // 0x800 + 1
+            size_sect = (self.size + 0x7FF) // 0x800
+            if size_sect > 0xFFFF:
+                raise ValueError('{0} is too large for a .hed record ({1} b)'.format(self.name, self.size))
             return pack('<HHHH', ofs_low, ofs_high, size_sect, size_low)
 
         elif blocksize == 4:
-            # ofssz_high = self.size // 0x800
-            ofs_aligned = self.offset // 0x800
+            # 4-byte records only store the size in sectors, in the low 12 bits of the high word
+            size_sect = (self.size + 0x7FF) // 0x800
+            if size_sect > 0x0FFF:
+                raise ValueError('{0} is too large for a .hed record ({1} b)'.format(self.name, self.size))
             ofs_low = ofs_aligned & 0xFFFF
-            ofssz_high = (ofs_aligned & 0xF0000) >> 4
+            ofssz_high = ((ofs_aligned & 0xF0000) >> 4) | size_sect
             return pack('<HH', ofs_low, ofssz_high)
 
 
-def writefile_in_directory_with_collisions(dirpath, ent, mrgfile, collision_suffix):
-    if (ent.name is None) or (len(ent.name) == 0):
-        newname = collision_suffix
-        path = dirpath.joinpath(newname)
-    else:
-        newname = None
-        path = dirpath.joinpath(ent.name)
+def hed_record_length(hed_head):
+    """Record length of a .hed (8 or 4 bytes), guessed from its first record"""
+    foo, first_entry_high = unpack_from('<HH', hed_head)
+    return 8 if (first_entry_high & 0x0FFF) == 0 else 4
+
 
-        if path.exists():
-            root, ext = os.path.splitext(ent.name)
-            newname = root + '-' + collision_suffix + ext
-            path = dirpath.joinpath(newname)
+def map_file(f):
+    """Read-only memory map of an open file"""
+    if os.fstat(f.fileno()).st_size == 0:
+        return b''  # empty files can not be mapped
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-    path.with_suffix('.at9')
 
-    mrgfile.seek(ent.offset)
-    with open(path, 'wb') as f:
-        f.write(mrgfile.read(ent.size))
+def read_hed_entries(hed, entry_length):
+    """Return the record number and HedEntry of each live record of a whole .hed"""
+    records = [record for record in range(len(hed) // entry_length)
+               if unpack_from('<L', hed, record * entry_length)[0] != 0xFFFFFFFF]
+    return records, [HedEntry(hed[record * entry_length:(record + 1) * entry_length]) for record in records]
+
+
+def live_clusters(entries):
+    """
+    Group the sector ranges used by entries into [start, end, [entry indices]] clusters, in offset order.
+    Entries sharing or overlapping sectors end up in the same cluster.
+    """
+    clusters = []
+    for idx in sorted(range(len(entries)), key=lambda idx: entries[idx].offset):
+        start = entries[idx].offset // 0x800
+        end = start + (entries[idx].rounded_size + 0x7FF) // 0x800
+        if start == end:
+            continue
+        if clusters and start < clusters[-1][1]:
+            clusters[-1][1] = max(clusters[-1][1], end)
+            clusters[-1][2].append(idx)
+        else:
+            clusters.append([start, end, [idx]])
+    return clusters
+
+
+def filenames_with_collisions(names, collision_suffixes):
+    """
+    Output file name of each entry: its name, or name-suffix.ext when an earlier entry already took it,
+    or the bare suffix when it has no name. Decided up front so that the result does not depend on write order.
+    """
+    taken = set()
+    filenames = []
+    for name, collision_suffix in zip(names, collision_suffixes):
+        if (name is None) or (len(name) == 0):
+            filename = collision_suffix
+        else:
+            filename = name
+            if os.path.normcase(filename) in taken:
+                root, ext = os.path.splitext(name)
+                filename = root + '-' + collision_suffix + ext
+        taken.add(os.path.normcase(filename))
+        filenames.append(filename)
+    return filenames
+
 
-    return newname  # None or string
+def _copy_file_range(srcfd, dstfd, offset, count):
+    return os.copy_file_range(srcfd, dstfd, count, offset)
 
 
-def get_entry_index_by_name(entries_list, name):
-    for idx in range(len(entries_list)):
-        if entries_list[idx]['name'] == name:
-            return idx
-    return -1
+def _sendfile(srcfd, dstfd, offset, count):
+    return os.sendfile(dstfd, srcfd, offset, count)
+
+
+KERNEL_COPIES = [copy for name, copy in [('copy_file_range', _copy_file_range), ('sendfile', _sendfile)]
+                 if hasattr(os, name)]
+COPY_CHUNK_SIZE = 0x400000
+
+
+def copy_range(srcfd, offset, size, dstfd, srcmap=None):
+    """
+    Copy size bytes at offset of srcfd to the current position of dstfd, inside the kernel when
+    copy_file_range/sendfile support the pair of files, else by writing chunks of srcmap (a buffer over srcfd).
+    The position of srcfd is left untouched so that threads can share it.
+    """
+    for kernel_copy in KERNEL_COPIES:
+        try:
+            while size > 0:
+                copied = kernel_copy(srcfd, dstfd, offset, size)
+                if copied == 0:
+                    raise EOFError("source ends before offset {0:08X}".format(offset))
+                offset += copied
+                size -= copied
+            return
+        except OSError:
+            pass  # not supported for these files, carry on with the next method
+    with memoryview(srcmap) as view:
+        while size > 0:
+            chunk = view[offset:offset + min(size, COPY_CHUNK_SIZE)]
+            if len(chunk) == 0:
+                raise EOFError("source ends before offset {0:08X}".format(offset))
+            written = os.write(dstfd, chunk)
+            chunk.release()
+            offset += written
+            size -= written
+
+
+def extract_entry(archive, index, path):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        copy_range(archive.mrg_fileno, archive.offsets[index], archive.sizes[index], fd, archive.mrg_map)
+    finally:
+        os.close(fd)
+
+
+FILELIST_TABLE_MAGIC = b'HFL2'
+FILELIST_TABLE_HEADER = '<4sIII'  # magic, entry count, settings size, string pool size
+# name offset, name size, path offset, path size (offset 0xFFFFFFFF for none), .hed record number
+FILELIST_TABLE_ENTRY = '<IIIII'
+FILELIST_TABLE_ENTRY_V1 = '<IIII'  # HFL1 tables have no record numbers
+
+
+class FilelistTable:
+    """
+    Entries of a binary filelist (.hfl): fixed-size records pointing into a UTF-8 string pool.
+    Entries are decoded on first access, edits to the returned dicts are kept.
+    """
+
+    def __init__(self, data, table_offset, count, entry_format=FILELIST_TABLE_ENTRY):
+        self.data = data
+        self.table_offset = table_offset
+        self.entry_format = entry_format
+        self.pool_offset = table_offset + count * calcsize(entry_format)
+        self.count = count
+        self.cache = {}
+
+    def __len__(self):
+        return self.count
+
+    def _string(self, offset, size):
+        if offset == 0xFFFFFFFF:
+            return None
+        start = self.pool_offset + offset
+        return self.data[start:start + size].decode('utf-8')
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('filelist entry index out of range')
+        entry = self.cache.get(index)
+        if entry is None:
+            fields = unpack_from(self.entry_format, self.data, self.table_offset + index * calcsize(self.entry_format))
+            entry = self.cache[index] = {'name': self._string(*fields[0:2]), 'path': self._string(*fields[2:4])}
+            if len(fields) > 4:
+                entry['record'] = fields[4]
+        return entry
+
+
+def filelist_format(path):
+    suffix = str.upper(os.path.splitext(str(path))[1])
+    return 'json' if suffix == '.JSON' else 'table' if suffix == '.HFL' else 'yaml'
+
+
+def load_filelist(path):
+    """Load a filelist, as JSON (.json), binary table (.hfl) or YAML (anything else)"""
+    fmt = filelist_format(path)
+    if fmt == 'table':
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, count, settings_size, pool_size = unpack_from(FILELIST_TABLE_HEADER, data)
+        if magic not in (FILELIST_TABLE_MAGIC, b'HFL1'):
+            raise CustomException("'{0}' is not a binary filelist".format(path))
+        start = calcsize(FILELIST_TABLE_HEADER)
+        filelist = OrderedDict(json.loads(data[start:start + settings_size].decode('utf-8')))
+        filelist['entries'] = FilelistTable(data, start + settings_size, count,
+                                            FILELIST_TABLE_ENTRY if magic == FILELIST_TABLE_MAGIC
+                                            else FILELIST_TABLE_ENTRY_V1)
+        return filelist
+    with open(path, 'rt', encoding='utf-8') as f:
+        if fmt == 'json':
+            return OrderedDict(json.load(f))
+        return yaml.load(f, Loader=FilelistLoader)
+
+
+def save_filelist(path, filelist):
+    fmt = filelist_format(path)
+    if fmt == 'table':
+        pool = bytearray()
+        pooled = {}
+        table = bytearray()
+        for index, entry in enumerate(filelist['entries']):
+            fields = []
+            for string in (entry['name'], entry['path']):
+                if string is None:
+                    fields += [0xFFFFFFFF, 0]
+                    continue
+                bstring = string.encode('utf-8')
+                if bstring not in pooled:
+                    pooled[bstring] = len(pool)
+                    pool += bstring
+                fields += [pooled[bstring], len(bstring)]
+            # entries of filelists without record numbers follow each other
+            record = entry.get('record')
+            fields.append(index if record is None else record)
+            table += pack(FILELIST_TABLE_ENTRY, *fields)
+        settings = json.dumps(OrderedDict((key, value) for key, value in filelist.items() if key != 'entries'),
+                              ensure_ascii=False).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(pack(FILELIST_TABLE_HEADER, FILELIST_TABLE_MAGIC, len(filelist['entries']), len(settings),
+                         len(pool)))
+            f.write(settings)
+            f.write(table)
+            f.write(pool)
+        return
+    if isinstance(filelist['entries'], FilelistTable):
+        filelist = OrderedDict(filelist)
+        filelist['entries'] = list(filelist['entries'])
+    with open(path, 'wt', encoding='utf-8', newline='') as f:
+        if fmt == 'json':
+            json.dump(filelist, f, ensure_ascii=False, indent=1)
+        else:
+            yaml.dump(filelist, f, Dumper=FilelistDumper)
 
 
 def write_entry_with_padding(infile, entry, outfile):
@@ -178,43 +398,43 @@ class NamUtil:
     """
 
     def __init__(self, in_nam):
-        self.data = open(in_nam, 'rb')
+        with open(in_nam, 'rb') as f:
+            self.data = f.read()  # names are small, the whole .nam is kept in memory
         self.base_stem = in_nam
         self.encoding = 'Shift_JIS'
         self.indexed = False
         self.nam_length = None
         self.nam_total = None
         self.nam_index = None
-        self.nam_size = os.path.getsize(in_nam)
+        self.nam_size = len(self.data)
+        self.names = {}  # decoded names, filled on first use
+        self.name_index = None
         self.get_info()
 
     def get_info(self):
         self.check_indexed()
         if not self.indexed:
             self.check_nam_length()
+            self.nam_total = self.nam_size // self.nam_length
             return
-            # return [self.indexed, self.nam_length, self.nam_total]
         self.check_nam_total()
         self.make_nam_index()
-        # return [self.indexed, self.nam_length, self.nam_total]
 
     def check_indexed(self):
-        if self.data.read(0x7) == b'MRG.NAM':
+        if self.data[:0x7] == b'MRG.NAM':
             self.indexed = True
-            self.nam_index = OrderedDict()
 
     def check_nam_length(self):
         self.nam_length = 0x8 if self.base_stem.name.find('voice') >= 0 else 0x20
 
     def check_nam_total(self):
-        self.data.seek(0x10)
-        self.nam_total, = unpack("<I", self.data.read(0x4))
+        self.nam_total, = unpack_from("<I", self.data, 0x10)
 
     def make_nam_index(self):
-        self.data.seek(0x20)
-        for i in range(self.nam_total):
-            self.nam_index[i], = unpack("<I", self.data.read(0x4))
-        self.nam_index[self.nam_total] = self.nam_size
+        self.nam_index = array('I', self.data[0x20:0x20 + 4 * self.nam_total])
+        if sys.byteorder != 'little':
+            self.nam_index.byteswap()
+        self.nam_index.append(self.nam_size)
 
     def read_0_string(self, bstr):
         try:
@@ -223,21 +443,152 @@ class NamUtil:
             return bstr.decode(self.encoding)
 
     def get_name_with_index(self, count):
-        length = self.nam_index[count + 1] - self.nam_index[count] - 4
-        self.data.seek(self.nam_index[count])
-        in_count, = unpack("<I", self.data.read(4))
+        start = self.nam_index[count]
+        in_count, = unpack_from("<I", self.data, start)
         if in_count == count:
-            return self.data.read(length)
+            return self.data[start + 4:self.nam_index[count + 1]]
         else:
-            print('ERR: can not get name from index {0}, the in-header index is {1}', count, in_count)
+            print('ERR: can not get name from index {0}, the in-header index is {1}'.format(count, in_count),
+                  file=stderr)
+            return b''
 
     def get_name(self, count):
-        if self.indexed:
-            name = self.get_name_with_index(count)
-        else:
-            self.data.seek(self.nam_length * count)
-            name = self.data.read(self.nam_length)
-        return self.read_0_string(name)
+        name = self.names.get(count)
+        if name is None:
+            if self.indexed:
+                bname = self.get_name_with_index(count)
+            else:
+                bname = self.data[self.nam_length * count:self.nam_length * (count + 1)]
+            name = self.names[count] = self.read_0_string(bname)
+        return name
+
+    def __len__(self):
+        return self.nam_total
+
+    def get_index(self, name):
+        """Index of the first record called name, -1 if there is none"""
+        if self.name_index is None:
+            self.name_index = {}
+            for count in range(len(self) - 1, -1, -1):
+                self.name_index[self.get_name(count)] = count
+        return self.name_index.get(name, -1)
+
+
+class HedArchive:
+    """
+    Read-only view of a .hed/.nam/.mrg triple.
+    The .hed and .mrg are memory-mapped and the .hed is parsed once into arrays of offsets and sizes.
+    Entries are the live .hed records, in the order and with the indices of the unpack filelist,
+    and are returned as zero-copy memoryview slices of the .mrg.
+    """
+
+    def __init__(self, in_hed):
+        self.path = Path(in_hed)
+        in_nam = self.path.with_suffix('.nam')
+        self.nam = NamUtil(in_nam) if in_nam.is_file() else None
+        self.records = array('L')  # .hed record number (.nam index) of each entry
+        self.offsets = array('Q')
+        self.sizes = array('L')
+        self._name_index = None
+
+        with open(self.path, 'rb') as hedfile:
+            self._hed = map_file(hedfile)
+        self.entry_length = hed_record_length(self._hed)
+        self._parse(self._hed)
+
+        self._mrgfile = open(self.path.with_suffix('.mrg'), 'rb')
+        self._mrg = map_file(self._mrgfile)
+        self._view = memoryview(self._mrg)
+        self.mrg_fileno = self._mrgfile.fileno()
+        self.mrg_map = self._mrg
+
+    def _parse(self, hed):
+        # same decoding as HedEntry, without creating an object per record
+        fmt = '<HHHH' if self.entry_length == 8 else '<HH'
+        with memoryview(hed) as view:
+            table = view[:len(hed) - len(hed) % self.entry_length]
+            for record, fields in enumerate(iter_unpack(fmt, table)):
+                ofs_low, ofs_high = fields[0], fields[1]
+                if ofs_low == 0xFFFF and ofs_high == 0xFFFF:
+                    continue
+                self.records.append(record)
+                self.offsets.append(0x800 * (ofs_low | ((ofs_high & 0xF000) << 4)))
+                if self.entry_length == 4:
+                    self.sizes.append(0x800 * (ofs_high & 0x0FFF))
+                elif fields[3] == 0:
+                    self.sizes.append(0x800 * fields[2])
+                else:
+                    self.sizes.append(fields[3] | ((0x800 * (fields[2] - 1)) & 0xFFFF0000))
+            table.release()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, key):
+        return self.read(self.index_of(key) if isinstance(key, str) else key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, index) -> memoryview:
+        """Contents of entry index, valid until the archive is closed"""
+        offset = self.offsets[index]
+        return self._view[offset:offset + self.sizes[index]]
+
+    def name(self, index):
+        return None if self.nam is None else self.nam.get_name(self.records[index])
+
+    def index_of(self, name):
+        """Index of the first entry called name, KeyError if there is none"""
+        if self._name_index is None:
+            self._name_index = {}
+            for index in range(len(self)):
+                self._name_index.setdefault(self.name(index), index)
+        return self._name_index[name]
+
+    def entry(self, index) -> HedEntry:
+        start = self.records[index] * self.entry_length
+        return HedEntry(self._hed[start:start + self.entry_length], name=self.name(index))
+
+    def close(self):
+        """Unmap the archive, memoryviews returned by read() must have been released"""
+        self._view.release()
+        for mapped in (self._hed, self._mrg):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        self._mrgfile.close()
+
+
+NAM_HEADER_SIZE = 0x20
+
+
+def write_nam(namfile, names, nam_length=None, nam_header=None):
+    """
+    Write names as a .nam: fixed nam_length-byte records, or the indexed 'MRG.NAM' layout when nam_length
+    is None (header, offset table, then index + name records).
+    """
+    encoded = [(name or '').encode('Shift_JIS') for name in names]
+    if nam_length is not None:
+        for name, bname in zip(names, encoded):
+            if len(bname) > nam_length:
+                raise CustomException("name '{0}' does not fit in {1}-byte .nam records".format(name, nam_length))
+            namfile.write(bname.ljust(nam_length, b'\x00'))
+        return
+
+    header = bytearray(nam_header or b'MRG.NAM'.ljust(NAM_HEADER_SIZE, b'\x00'))
+    header[0x10:0x14] = pack('<I', len(names))
+    offset = NAM_HEADER_SIZE + 4 * len(names)
+    offsets = []
+    for bname in encoded:
+        offsets.append(offset)
+        offset += 4 + len(bname) + 1
+    namfile.write(header)
+    namfile.write(pack('<{0}I'.format(len(offsets)), *offsets))
+    for index, bname in enumerate(encoded):
+        namfile.write(pack('<I', index) + bname + b'\x00')
 
 
 #############################################################################
@@ -250,12 +601,22 @@ def parse_args():
     parser_unpack.add_argument('-f', '--filelist',
                                default=None, dest='filelist',
                                help='Output filelist path (default: none -- only unpack files)')
+    parser_unpack.add_argument('-j', '--jobs',
+                               default=1, dest='jobs', type=int,
+                               help='Number of files written in parallel, 0 for one per CPU (default: 1)')
+    parser_unpack.add_argument('-p', '--progress',
+                               action='store_true', dest='progress',
+                               help='Show a progress counter instead of one line per entry')
+    parser_unpack.add_argument('-u', '--update',
+                               action='store_true', dest='update',
+                               help='Update an existing output directory: only extract the entries that changed '
+                                    'since the last unpack, or that an interrupted unpack did not write')
     parser_unpack.add_argument('input', metavar='input.hed', help='Input .hed file')
 
     parser_replace = subparsers.add_parser('replace',
                                            help='replace an archive entry in-place and modify an existing filelist. You may omit -n/-i when providing a wildcard expression to --source-file')
     parser_replace.add_argument('-f', '--filelist',
-                                required=True, dest='filelist', type=argparse.FileType('r'),
+                                required=True, dest='filelist',
                                 help='Subject filelist path, modified in-place [REQUIRED]')
     parser_replace.add_argument('-s', '--source-file',
                                 required=True, dest='source', metavar='sourcepath',
@@ -272,11 +633,62 @@ def parse_args():
 
     parser_repack = subparsers.add_parser('repack', help='generate a hed/nam/mrg triple from an existing filelist')
     parser_repack.add_argument('-f', '--filelist',
-                               required=True, dest='filelist', type=argparse.FileType('r'),
+                               required=True, dest='filelist',
                                help='Input filelist path [REQUIRED]')
     parser_repack.add_argument('output', metavar='output.hed',
                                help='Output .hed file. Same basename is used for .nam/.mrg')
 
+    parser_compact = subparsers.add_parser('compact',
+                                           help='remove the unused sectors left in the .mrg by replace, in-place or into a new triple')
+    parser_compact.add_argument('-o', '--output',
+                                default=None, dest='output', metavar='output.hed',
+                                help='Write a compacted copy of the triple (default: none -- compact in-place)')
+    parser_compact.add_argument('-n', '--dry-run',
+                                action='store_true', dest='dry_run',
+                                help='Only report how much space would be reclaimed')
+    parser_compact.add_argument('subject', metavar='existing.hed',
+                                help='Subject .hed file. Same basename is used for .nam/.mrg')
+
+    parser_convert = subparsers.add_parser('convert',
+                                           help='convert a filelist between YAML, JSON (.json) and binary table (.hfl)')
+    parser_convert.add_argument('input', metavar='input_filelist', help='Input filelist')
+    parser_convert.add_argument('output', metavar='output_filelist',
+                                help='Output filelist, its extension selects the format')
+
+    parser_diff = subparsers.add_parser('diff',
+                                        help='write a patch holding the .hed records and .mrg sectors that differ between two triples')
+    parser_diff.add_argument('-o', '--output',
+                             required=True, dest='output', metavar='patch.hpt',
+                             help='Output patch file [REQUIRED]')
+    parser_diff.add_argument('original', metavar='original.hed', help='Original .hed file')
+    parser_diff.add_argument('patched', metavar='patched.hed', help='Patched .hed file')
+
+    parser_apply = subparsers.add_parser('apply', help='apply a patch made by diff onto an original triple, in-place')
+    parser_apply.add_argument('patch', metavar='patch.hpt', help='Patch file')
+    parser_apply.add_argument('subject', metavar='original.hed',
+                              help='Subject .hed file, modified in-place. Same basename is used for .nam/.mrg')
+
+    parser_index = subparsers.add_parser('index',
+                                         help='record the entries of every hed/nam/mrg triple and mrgd00 container '
+                                              'in an SQLite database, then optionally search it')
+    parser_index.add_argument('-d', '--database',
+                              default='hedindex.sqlite', dest='database',
+                              help='SQLite database, updated in-place (default: hedindex.sqlite)')
+    parser_index.add_argument('-n', '--no-scan',
+                              action='store_true', dest='no_scan',
+                              help='Only search the database, do not scan for changed containers')
+    parser_index.add_argument('-q', '--query',
+                              default=None, dest='query', metavar='PATTERN',
+                              help='List the entries whose name matches PATTERN (* and ? wildcards)')
+    parser_index.add_argument('-t', '--type',
+                              default=None, dest='type', choices=sorted(set(ENTRY_TYPES.values())),
+                              help='Only list entries of this type (from their magic bytes)')
+    parser_index.add_argument('-s', '--min-size',
+                              default=None, dest='min_size', type=int,
+                              help='Only list entries of at least MIN_SIZE bytes')
+    parser_index.add_argument('roots', metavar='path', nargs='*', default=['.'],
+                              help='Containers or directories scanned recursively (default: .)')
+
     parser.add_argument('-h', '--help',
                         action=CustHelpAction, default=argparse.SUPPRESS,
                         help='show this help message and exit')
@@ -287,57 +699,125 @@ def parse_args():
 #############################################################################
 # unpack verb #
 ###############
+MANIFEST_MAGIC = '#hedutil-manifest'
+
+
+def mrg_signature(mrg_path):
+    st = os.stat(mrg_path)
+    return '{0}\t{1}'.format(st.st_size, st.st_mtime_ns)
+
+
+def read_manifest(path, signature):
+    """
+    Load an unpack manifest as {index: [offset, size, crc32, filename, trusted]}, the last line of an index wins.
+    Lines written while the .mrg had another signature (size and mtime) are not trusted, their crc32 must be checked.
+    """
+    manifest = {}
+    trusted = False
+    try:
+        with open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if fields[0] == MANIFEST_MAGIC:
+                    trusted = '\t'.join(fields[1:]) == signature
+                elif len(fields) == 5:
+                    manifest[int(fields[0])] = [int(fields[1]), int(fields[2]), int(fields[3], 16), fields[4], trusted]
+    except FileNotFoundError:
+        pass
+    return manifest
+
+
 def unpack_verb(args):
     in_hed = Path(args.input)
-    in_nam = in_hed.with_suffix('.nam')
-    in_mrg = in_hed.with_suffix('.mrg')
-    hedfile = namfile = mrgfile = None
+    archive = None
     outputdir = in_hed.with_name(in_hed.stem + '-unpacked')
 
     try:
         if str.upper(in_hed.suffix) != '.HED':
             raise CustomException("'{}' must be a .hed file".format(args.input))
-        hedfile = open(in_hed, 'rb')
-        if in_nam.is_file():
-            namfile = NamUtil(in_nam)
-        mrgfile = open(in_mrg, 'rb')
-        outputdir.mkdir(parents=True)
+        archive = HedArchive(in_hed)
+        outputdir.mkdir(parents=True, exist_ok=args.update)
     except Exception as exc:
         print("ERR: [{1}] failed to process \"{0}\" - {2}".format(args.input, type(exc).__name__, str(exc)),
               file=stderr)
         sys.exit(1)
 
-    foo, first_entry_high = unpack('<HH', hedfile.read(0x04))
-    entry_length = 8 if (first_entry_high & 0x0FFF) == 0 else 4
+    entry_length = archive.entry_length
     record_count = in_hed.stat().st_size // entry_length
     write_line('-')
     print("| Archive count: {0} entries".format(record_count), file=stderr)
     write_line('-')
-    hedfile.seek(0)
     indexed_fmt = '{0:04d}' if record_count < 10000 else '{0:06d}'
 
+    names = [archive.name(i) for i in range(len(archive))]
+    filenames = filenames_with_collisions(names, [indexed_fmt.format(record) for record in archive.records])
+
     yamlobj = OrderedDict()
     yamlobj['original name'] = args.input
-    yamlobj['storage directory'] = outputdir
+    yamlobj['storage directory'] = str(outputdir)
     yamlobj['hed record length'] = entry_length
-    yamlobj['has nam filelist'] = namfile is not None
-    yamlobj['entries'] = []
-    for i in range(record_count):
-        blob = hedfile.read(entry_length)
-        first_word, = unpack_from('<L', blob)
-        if first_word == 0xFFFFFFFF:
-            continue
-        namfilename = None if namfile is None else namfile.get_name(i)
-        entry = HedEntry(blob, name=namfilename)
-        print("|- {0} - {1} b".format(entry.name, entry.size), file=stderr)
-        newfilename = writefile_in_directory_with_collisions(outputdir, entry, mrgfile,
-                                                             collision_suffix=indexed_fmt.format(i))
-        yamlobj['entries'].append({'name': namfilename, 'path': newfilename if newfilename is not None else entry.name})
+    yamlobj['has nam filelist'] = archive.nam is not None
+    if archive.nam is not None:
+        yamlobj['nam record length'] = archive.nam.nam_length  # none for the indexed MRG.NAM layout
+        if archive.nam.indexed:
+            yamlobj['nam header'] = archive.nam.data[:NAM_HEADER_SIZE].hex()
+    # the record number keeps the .hed index of each entry, dead records are left out of the filelist
+    yamlobj['entries'] = [{'name': name, 'path': filename, 'record': record}
+                          for name, filename, record in zip(names, filenames, archive.records)]
+
+    # every written entry is appended to the manifest, so that an interrupted run can be resumed with --update
+    manifest_path = in_hed.with_name(in_hed.stem + '-unpacked.manifest')
+    signature = mrg_signature(in_hed.with_suffix('.mrg'))
+    manifest = read_manifest(manifest_path, signature) if args.update else {}
+
+    def extract(i):
+        path = outputdir.joinpath(filenames[i])
+        known = manifest.get(i)
+        checksum = None
+        if known is not None and known[0:2] == [archive.offsets[i], archive.sizes[i]] and known[3] == filenames[i]:
+            if known[4]:
+                checksum = known[2]
+            else:  # the .mrg changed since, the entry may have been replaced in-place
+                with archive.read(i) as view:
+                    checksum = zlib.crc32(view)
+            if checksum == known[2] and path.is_file() and path.stat().st_size == archive.sizes[i]:
+                return i, checksum, False
+        extract_entry(archive, i, path)
+        if checksum is None:
+            with archive.read(i) as view:
+                checksum = zlib.crc32(view)
+        return i, checksum, True
+
+    nextracted = 0
+    jobs = args.jobs or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=jobs) as executor, \
+            open(manifest_path, 'at' if args.update else 'wt', encoding='utf-8', newline='\n') as manifestfile:
+        manifestfile.write('{0}\t{1}\n'.format(MANIFEST_MAGIC, signature))
+        for done, (i, checksum, extracted) in enumerate(executor.map(extract, range(len(archive))), 1):
+            manifest[i] = [archive.offsets[i], archive.sizes[i], checksum, filenames[i], True]
+            if extracted:
+                nextracted += 1
+                manifestfile.write('{0}\t{1}\t{2}\t{3:08x}\t{4}\n'.format(i, *manifest[i]))
+            if not args.progress:
+                if extracted:
+                    print("|- {0} - {1} b".format(names[i], archive.sizes[i]), file=stderr)
+            elif done % 256 == 0 or done == len(archive):
+                print("\r| Extracted: {0}/{1}".format(done, len(archive)), end='', file=stderr)
+    if args.progress and len(archive) > 0:
+        print(file=stderr)
+    archive.close()
+
+    # complete run, rewrite the manifest without the superseded lines
+    with open(manifest_path, 'wt', encoding='utf-8', newline='\n') as manifestfile:
+        manifestfile.write('{0}\t{1}\n'.format(MANIFEST_MAGIC, signature))
+        for i in range(len(filenames)):
+            manifestfile.write('{0}\t{1}\t{2}\t{3:08x}\t{4}\n'.format(i, *manifest[i]))
+    if args.update:
+        print("| Updated: {0} of {1} entries".format(nextracted, len(filenames)), file=stderr)
 
     write_line('=')
     if args.filelist is not None:
-        with open(in_hed.with_name(args.filelist), 'wt', newline='') as yamlfile:
-            yaml.dump(yamlobj, yamlfile)
+        save_filelist(in_hed.with_name(args.filelist), yamlobj)
         print('Filelist: {}'.format(args.filelist), file=stderr)
     print('Output Directory: {}'.format(outputdir), file=stderr)
 
@@ -362,9 +842,9 @@ def replace_verb(args):
 
     yamlobj = None
     try:
-        yamlobj = yaml.load(args.filelist)
-    except yaml.YAMLError as exc:
-        print("ERR: [{1}] failed to process \"{0}\" - {2}".format(args.filelist.name, type(exc).__name__, str(exc)),
+        yamlobj = load_filelist(args.filelist)
+    except Exception as exc:
+        print("ERR: [{1}] failed to process \"{0}\" - {2}".format(args.filelist, type(exc).__name__, str(exc)),
               file=stderr)
         sys.exit(1)
 
@@ -375,22 +855,22 @@ def replace_verb(args):
         sourcepaths = [x for x in glob.iglob(args.source) if os.path.isfile(x)]
         if len(sourcepaths) == 0:
             print("ERR: failed to process \"{0}\" - --source expression {1} does not match any file".format(
-                args.filelist.name, args.source), file=stderr)
+                args.filelist, args.source), file=stderr)
             sys.exit(1)
     else:
         if os.path.isdir(args.source):
             sourcepaths = [x for x in glob.iglob(os.path.join(args.source, '*')) if os.path.isfile(x)]
             if len(sourcepaths) == 0:
                 print("ERR: failed to process \"{0}\" - no file match in --source {1} directory".format(
-                    args.filelist.name, args.source), file=stderr)
-            sys.exit(1)
+                    args.filelist, args.source), file=stderr)
+                sys.exit(1)
         elif os.path.isfile(args.source):
             sourcepaths = [args.source]
             if (args.index is None) and (args.name is None):
                 args.name = os.path.basename(args.source)
 
     if len(sourcepaths) == 0:
-        print("ERR: failed to process \"{0}\" - --source {1} does not match any file".format(args.filelist.name,
+        print("ERR: failed to process \"{0}\" - --source {1} does not match any file".format(args.filelist,
                                                                                              args.source), file=stderr)
         sys.exit(1)
     elif len(sourcepaths) == 1:
@@ -403,88 +883,154 @@ def replace_verb(args):
 
     nsuccess = nfailed = 0
 
+    name_index = {}
+    for idx, item in enumerate(yamlobj['entries']):
+        name_index.setdefault(item['name'], idx)
+    replacements = OrderedDict()
     for spath in sourcepaths:
         if special_first == True:
             ent_index = args.index
             ent_name = args.name
-            is_first = False
         else:
             ent_index = None
             ent_name = os.path.basename(spath)
-        result, newyaml = replace_entry(yamlobj, {'filelist': args.filelist.name, 'path': spath, 'index': ent_index,
-                                                  'name': ent_name, 'hedfile': hedfile, 'mrgfile': mrgfile})
-        if result == 0: nsuccess += 1
-        if result != 0: nfailed += 1
+        ent_index = resolve_entry_index(yamlobj, name_index, {'filelist': args.filelist, 'index': ent_index,
+                                                              'name': ent_name})
+        if ent_index < 0:
+            nfailed += 1
+            continue
+        if ent_index in replacements:
+            print("WRN: \"{0}\" replaces idx={1} again, \"{2}\" is skipped".format(
+                spath, ent_index, replacements[ent_index]), file=stderr)
+            nfailed += 1
+        replacements[ent_index] = spath
+
+    try:
+        nsuccess += len(replace_entries(yamlobj, replacements, hedfile, mrgfile))
+    except Exception as exc:
+        print("ERR: [{1}] failed to replace entries of \"{0}\" - {2}".format(args.subject, type(exc).__name__,
+                                                                              str(exc)), file=stderr)
+        sys.exit(1)
+    finally:
+        hedfile.close()
+        mrgfile.close()
 
     print("Success = {0}\nFailed = {1}".format(nsuccess, nfailed))
 
     try:
-        # reopen with truncation
-        with open(args.filelist.name, 'wt', newline='') as yamlfile:
-            yaml.dump(yamlobj, yamlfile)
-        print('Filelist: {}'.format(args.filelist.name), file=stderr)
+        save_filelist(args.filelist, yamlobj)
+        print('Filelist: {}'.format(args.filelist), file=stderr)
     except Exception as exc:
-        print("ERR: [{1}] failed to write filelist into \"{0}\" - {2}".format(args.filelist.name, type(exc).__name__,
+        print("ERR: [{1}] failed to write filelist into \"{0}\" - {2}".format(args.filelist, type(exc).__name__,
                                                                               str(exc)), file=stderr)
         failsafe = 'failsafe.yml'
         try:
             print(">> Attempting to save filelist as \"{}\" in current directory".format(failsafe), file=stderr)
-            with open(failsafe, 'wt', newline='') as yamlfile:
-                yaml.dump(yamlobj, yamlfile)
+            save_filelist(failsafe, yamlobj)
         except Exception as exc:
             print("ERR: could not save to \"{}\" either. Dumping as base64 in console...".format(failsafe), file=stderr)
-            print(b64encode(yaml.dump(yamlobj).encode('utf-8')))
-        print(">> Failsafe save OK, please manually rename it as {}.".format(args.filelist.name), file=stderr)
+            print(b64encode(json.dumps(yamlobj, default=list).encode('utf-8')))
+        print(">> Failsafe save OK, please manually rename it as {}.".format(args.filelist), file=stderr)
         sys.exit(2)
 
     sys.exit(0)
 
 
-def replace_entry(yamlobj, opts):
-    entry_length = yamlobj['hed record length']
+def resolve_entry_index(yamlobj, name_index, opts):
+    """Filelist index of the entry referred to by opts['index'] or opts['name'], -1 (after an error) if none"""
     search_by_name = opts['name'] is not None
     if not search_by_name:
         if (opts['index'] < 0) or (opts['index'] >= len(yamlobj['entries'])):
             print("ERR: failed to process \"{0}\" - replace by --index '{1}' out of bounds [0, {2}]".format(
                 opts['filelist'], opts['index'], len(yamlobj['entries']) - 1), file=stderr)
-            return 2
-    else:
-        if not yamlobj['has nam filelist']:
-            print(
-                "ERR: failed to process \"{0}\" - replace by --name '{1}' while no .nam is used for "
-                "this .hed. Use --index instead".format(
-                    opts['filelist'], opts['name']), file=stderr)
-            return 2
-
-        opts['index'] = get_entry_index_by_name(yamlobj['entries'], opts['name'])
-        if opts['index'] < 0:
-            print(
-                "ERR: failed to process \"{0}\" - replace by --name '{1}' entry not found. Check if file case matches".format(
-                    opts['filelist'], opts['name']), file=stderr)
-            return 2
-
-    opts['hedfile'].seek(opts['index'] * entry_length)
-    entry = HedEntry(opts['hedfile'].read(entry_length))
-    print('Replacing: idx={0} {1} - orgOfs-Sz:{2:08X}-{3}b'.format(opts['index'],
-                                                                   yamlobj['entries'][opts['index']]['path'],
-                                                                   entry.offset, entry.size), file=stderr)
-
-    # if replaced entry has larger size, allocate new space
-    entry.size = os.path.getsize(opts['path'])
-    if os.path.getsize(opts['path']) > entry.rounded_size:
-        opts['mrgfile'].seek(0, 2)
-        entry.offset = opts['mrgfile'].tell()  # should be on 0x800 boundary
-        print('- newOfs-Sz:{0:08X}-{1}b'.format(entry.offset, entry.size), file=stderr)
-    size_low = entry.size & 0xFFFF
-    size_sect = entry.size // 0x800
-    entry.rounded_size = 0x800 * size_sect if size_low == 0 else 0x800 * (size_sect + 1)
-    write_entry_with_padding(open(opts['path'], 'rb'), entry, opts['mrgfile'])
-
-    opts['hedfile'].seek(opts['index'] * entry_length)
-    opts['hedfile'].write(entry.to_block(entry_length))
-
-    yamlobj['entries'][opts['index']]['path'] = opts['path']
-    return [0, yamlobj]
+            return -1
+        return opts['index']
+
+    if not yamlobj['has nam filelist']:
+        print(
+            "ERR: failed to process \"{0}\" - replace by --name '{1}' while no .nam is used for "
+            "this .hed. Use --index instead".format(
+                opts['filelist'], opts['name']), file=stderr)
+        return -1
+    index = name_index.get(opts['name'], -1)
+    if index < 0:
+        print(
+            "ERR: failed to process \"{0}\" - replace by --name '{1}' entry not found. Check if file case matches".format(
+                opts['filelist'], opts['name']), file=stderr)
+    return index
+
+
+def plan_replacements(entries, replaced, mrg_size):
+    """
+    Assign a new offset to every replaced entry (HedEntry with its new size) of entries, the list of all entries.
+    Sectors of the entries that are not replaced are kept and anything else in the .mrg is free space.
+    Replaced entries are placed largest first into the smallest free range that holds them (best fit),
+    or appended to the .mrg when none does.
+    """
+    live = sorted((ent.offset // 0x800, (ent.offset + ent.rounded_size + 0x7FF) // 0x800)
+                  for idx, ent in enumerate(entries) if idx not in replaced)
+    free = []  # (length, start) in sectors, sorted
+    end = 0
+    for start, stop in live:
+        if start > end:
+            free.append((start - end, end))
+        end = max(end, stop)
+    mrg_end = (mrg_size + 0x7FF) // 0x800
+    if mrg_end > end:
+        free.append((mrg_end - end, end))
+        end = mrg_end
+    free.sort()
+
+    for idx in sorted(replaced, key=lambda idx: (-replaced[idx].size, idx)):
+        ent = replaced[idx]
+        length = (ent.size + 0x7FF) // 0x800
+        ent.rounded_size = 0x800 * length
+        pos = bisect_left(free, (length, -1))
+        if length == 0:
+            ent.offset = entries[idx].offset
+        elif pos < len(free):
+            free_length, start = free.pop(pos)
+            if free_length > length:
+                insort(free, (free_length - length, start + length))
+            ent.offset = 0x800 * start
+        else:
+            ent.offset = 0x800 * end
+            end += length
+
+
+def replace_entries(yamlobj, replacements, hedfile, mrgfile):
+    """
+    Replace entries {filelist index: source path} in one pass: plan the new layout, then write the sources
+    in .mrg offset order and the whole .hed at once. Return the replaced indices.
+    """
+    entry_length = yamlobj['hed record length']
+    hed = bytearray(hedfile.read())
+    records, entries = read_hed_entries(hed, entry_length)
+    if len(entries) != len(yamlobj['entries']):
+        raise CustomException("filelist has {0} entries, .hed has {1}".format(len(yamlobj['entries']), len(entries)))
+
+    replaced = OrderedDict()
+    for idx, path in replacements.items():
+        ent = HedEntry(hed[records[idx] * entry_length:(records[idx] + 1) * entry_length])
+        ent.size = os.path.getsize(path)
+        replaced[idx] = ent
+    plan_replacements(entries, replaced, os.fstat(mrgfile.fileno()).st_size)
+
+    for idx in sorted(replaced, key=lambda idx: replaced[idx].offset):
+        ent = replaced[idx]
+        print('Replacing: idx={0} {1} - orgOfs-Sz:{2:08X}-{3}b'.format(idx, yamlobj['entries'][idx]['path'],
+                                                                       entries[idx].offset, entries[idx].size),
+              file=stderr)
+        if ent.offset != entries[idx].offset:
+            print('- newOfs-Sz:{0:08X}-{1}b'.format(ent.offset, ent.size), file=stderr)
+        with open(replacements[idx], 'rb') as infile:
+            write_entry_with_padding(infile, ent, mrgfile)
+        hed[records[idx] * entry_length:(records[idx] + 1) * entry_length] = ent.to_block(entry_length)
+        yamlobj['entries'][idx]['path'] = replacements[idx]
+
+    hedfile.seek(0)
+    hedfile.write(hed)
+    return list(replaced)
 
 
 #############################################################################
@@ -492,8 +1038,529 @@ def replace_entry(yamlobj, opts):
 ###############
 
 def repack_verb(args):
-    # TODO
-    raise CustomException("Sorry, this option is not implemented yet")
+    out_hed = Path(args.output)
+    yamlobj = None
+
+    try:
+        if str.upper(out_hed.suffix) != '.HED':
+            raise CustomException("'{}' must be a .hed file".format(args.output))
+        yamlobj = load_filelist(args.filelist)
+    except Exception as exc:
+        print("ERR: [{1}] failed to process \"{0}\" - {2}".format(args.filelist, type(exc).__name__, str(exc)),
+              file=stderr)
+        sys.exit(1)
+
+    print('Loaded Filelist: {0} >> {1}'.format(yamlobj['original name'], yamlobj['storage directory']), file=stderr)
+    entry_length = yamlobj['hed record length']
+    storagedir = Path(yamlobj['storage directory'])
+    write_line('-')
+    print("| Archive count: {0} entries".format(len(yamlobj['entries'])), file=stderr)
+    write_line('-')
+
+    try:
+        out_hed.parent.mkdir(parents=True, exist_ok=True)
+        # entries are streamed one after the other, each aligned on 0x800
+        names = []
+        with open(out_hed.with_suffix('.mrg'), 'wb') as mrgfile, open(out_hed, 'wb') as hedfile:
+            for item in yamlobj['entries']:
+                # dead records between entries are written back, so that entries keep their .hed record number
+                record = item.get('record')
+                if record is not None:
+                    if record < len(names):
+                        raise CustomException("record {0} of '{1}' is out of order".format(record, item['path']))
+                    hedfile.write(b'\xFF' * entry_length * (record - len(names)))
+                    names += [''] * (record - len(names))
+                names.append(item['name'])
+                # unpacked entries are relative to the storage directory, replaced ones to the working directory
+                path = storagedir.joinpath(item['path'])
+                if not path.is_file():
+                    path = Path(item['path'])
+                entry = HedEntry(bytes(entry_length), name=item['name'])
+                entry.offset = mrgfile.tell()
+                entry.size = path.stat().st_size
+                with open(path, 'rb') as infile:
+                    write_entry_with_padding(infile, entry, mrgfile)
+                hedfile.write(entry.to_block(entry_length))
+                print("|- {0} - {1} b".format(entry.name, entry.size), file=stderr)
+            hedfile.write(16 * b'\xFF')
+
+        if yamlobj['has nam filelist']:
+            if 'nam record length' in yamlobj:
+                nam_length = yamlobj['nam record length']
+            else:  # filelist from an older unpack, guess like NamUtil does
+                nam_length = 0x8 if Path(yamlobj['original name']).name.find('voice') >= 0 else 0x20
+            nam_header = yamlobj.get('nam header')
+            with open(out_hed.with_suffix('.nam'), 'wb') as namfile:
+                write_nam(namfile, names, nam_length, None if nam_header is None else bytes.fromhex(nam_header))
+    except Exception as exc:
+        print("ERR: [{1}] failed to repack \"{0}\" - {2}".format(args.output, type(exc).__name__, str(exc)),
+              file=stderr)
+        sys.exit(1)
+
+    write_line('=')
+    print('Output: {0}'.format(out_hed), file=stderr)
+
+
+#############################################################################
+# convert verb #
+################
+
+def convert_verb(args):
+    try:
+        filelist = load_filelist(args.input)
+        save_filelist(args.output, filelist)
+    except Exception as exc:
+        print("ERR: [{1}] failed to convert \"{0}\" - {2}".format(args.input, type(exc).__name__, str(exc)),
+              file=stderr)
+        sys.exit(1)
+    print('Filelist: {0} ({1} entries)'.format(args.output, len(filelist['entries'])), file=stderr)
+
+
+#############################################################################
+# compact verb #
+################
+
+def move_range(f, src, dst, size, bufsize=COPY_CHUNK_SIZE):
+    """Move size bytes of f from src down to dst (dst < src), ranges may overlap"""
+    buffer = bytearray(bufsize)
+    while size > 0:
+        f.seek(src)
+        count = f.readinto(memoryview(buffer)[:min(size, bufsize)])
+        if count == 0:
+            break
+        f.seek(dst)
+        f.write(memoryview(buffer)[:count])
+        src += count
+        dst += count
+        size -= count
+
+
+def plan_compaction(clusters, mrg_size):
+    """
+    New place of each cluster of live_clusters() so that the .mrg has no unused sectors, as [old start, new start,
+    size in bytes, entry indices] in bytes and in the order the moves can be made in-place. Gaps are filled from
+    the lowest one up with the largest cluster still to be placed that fits, the one nearest the end of the file
+    first; only when none fits is the cluster right after the gap slid down. Each cluster is moved at most once and
+    always into sectors that are free at that point.
+    """
+    pending = sorted((end - start, start) for start, end, indices in clusters)  # (length, start) in sectors
+    by_start = {start: [start, end, indices] for start, end, indices in clusters}
+    moves = []
+    cursor = 0
+
+    def place(length, start):
+        start, end, indices = by_start.pop(start)
+        del pending[bisect_left(pending, (length, start))]
+        moves.append([0x800 * start, 0x800 * cursor, max(0, min(0x800 * end, mrg_size) - 0x800 * start), indices])
+        return cursor + length
+
+    for start, end, indices in clusters:
+        if start not in by_start:
+            continue  # already moved into a lower gap
+        while cursor < start:
+            pos = bisect_left(pending, (start - cursor + 1, -1)) - 1
+            if pos < 0:
+                break
+            cursor = place(*pending[pos])
+            if start not in by_start:
+                break
+        if start in by_start:
+            cursor = place(end - start, start)
+    return moves
+
+
+def compact_verb(args):
+    in_hed = Path(args.subject)
+    in_mrg = in_hed.with_suffix('.mrg')
+    inplace = args.output is None and not args.dry_run
+    hedfile = mrgfile = None
+
+    try:
+        if str.upper(in_hed.suffix) != '.HED':
+            raise CustomException("'{}' must be a .hed file".format(args.subject))
+        if args.output is not None and str.upper(Path(args.output).suffix) != '.HED':
+            raise CustomException("'{}' must be a .hed file".format(args.output))
+        hedfile = open(in_hed, 'r+b' if inplace else 'rb')
+        mrgfile = open(in_mrg, 'r+b' if inplace else 'rb')
+    except Exception as exc:
+        print("ERR: [{1}] failed to process \"{0}\" - {2}".format(args.subject, type(exc).__name__, str(exc)),
+              file=stderr)
+        sys.exit(1)
+
+    hed = bytearray(hedfile.read())
+    entry_length = hed_record_length(hed)
+    records, entries = read_hed_entries(hed, entry_length)
+    clusters = live_clusters(entries)
+    mrg_size = os.fstat(mrgfile.fileno()).st_size
+
+    moves = plan_compaction(clusters, mrg_size)
+    new_size = max((dst + size for src, dst, size, indices in moves), default=0)
+    reclaimed = mrg_size - new_size
+    moved = [size for src, dst, size, indices in moves if src != dst]
+
+    write_line('-')
+    print("| Archive count: {0} entries, {1} in use".format(len(hed) // entry_length, len(entries)), file=stderr)
+    print("| Reclaimable: {0} b in {1} sectors ({2} b -> {3} b), {4} of {5} ranges to move ({6} b)".format(
+        reclaimed, (mrg_size + 0x7FF) // 0x800 - sum(end - start for start, end, indices in clusters), mrg_size,
+        new_size, len(moved), len(moves), sum(moved)), file=stderr)
+    write_line('-')
+    if args.dry_run:
+        sys.exit(0)
+
+    try:
+        if inplace:
+            for src, dst, size, indices in moves:
+                if src == dst:
+                    continue
+                move_range(mrgfile, src, dst, size)
+                # records follow each move, so an interruption leaves every entry readable but the one in transit
+                for idx in indices:
+                    entries[idx].offset += dst - src
+                    hedfile.seek(records[idx] * entry_length)
+                    hedfile.write(entries[idx].to_block(entry_length))
+            mrgfile.truncate(new_size)
+            output = in_hed
+        else:
+            output = Path(args.output)
+            output.parent.mkdir(parents=True, exist_ok=True)
+            srcmap = map_file(mrgfile)
+            with open(output.with_suffix('.mrg'), 'wb') as outfile:
+                for src, dst, size, indices in sorted(moves, key=lambda move: move[1]):
+                    outfile.seek(dst)  # a cluster ending in a partial sector may have been moved below another one
+                    copy_range(mrgfile.fileno(), src, size, outfile.fileno(), srcmap)
+                    for idx in indices:
+                        entries[idx].offset += dst - src
+                        hed[records[idx] * entry_length:(records[idx] + 1) * entry_length] = entries[idx].to_block(
+                            entry_length)
+            if isinstance(srcmap, mmap.mmap):
+                srcmap.close()
+            output.write_bytes(hed)
+            if in_hed.with_suffix('.nam').is_file():
+                output.with_suffix('.nam').write_bytes(in_hed.with_suffix('.nam').read_bytes())
+    except Exception as exc:
+        print("ERR: [{1}] failed to compact \"{0}\" - {2}".format(args.subject, type(exc).__name__, str(exc)),
+              file=stderr)
+        sys.exit(1)
+    finally:
+        hedfile.close()
+        mrgfile.close()
+
+    write_line('=')
+    print('Output: {0}'.format(output), file=stderr)
+
+
+#############################################################################
+# diff / apply verbs #
+######################
+# patch: header, then blocks (tag, position, size, crc32 of the original range, crc32 of data) each followed by data
+PATCH_MAGIC = b'HEDPATCH'
+PATCH_HEADER = '<8sI6QI'  # magic, version, hed/mrg/nam sizes before and after, crc32 of the original .hed
+PATCH_BLOCK = '<4sQIII'
+PATCH_VERSION = 1
+PATCH_BLOCK_SIZE = COPY_CHUNK_SIZE
+PATCH_TAGS = {b'HED ': '.hed', b'MRG ': '.mrg', b'NAM ': '.nam'}
+
+
+def changed_ranges(old, new, unit, window=0x100000):
+    """
+    Yield (start, end) of the runs of unit-sized blocks of new that differ from old, or that old does not have.
+    Both are compared window bytes at a time (a multiple of unit) and block by block only where a window differs.
+    """
+    common = min(len(old), len(new))
+    start = None
+    for pos in range(0, common, window):
+        end = min(pos + window, common)
+        if old[pos:end] == new[pos:end]:
+            if start is not None:
+                yield start, pos
+                start = None
+            continue
+        for upos in range(pos, end, unit):
+            uend = min(upos + unit, end)
+            if old[upos:uend] != new[upos:uend]:
+                if start is None:
+                    start = upos
+            elif start is not None:
+                yield start, upos
+                start = None
+    if len(new) > common:
+        yield (common if start is None else start), len(new)
+    elif start is not None:
+        yield start, common
+
+
+def diff_verb(args):
+    paths = [Path(args.original), Path(args.patched)]
+    files = []
+    try:
+        for path in paths:
+            if str.upper(path.suffix) != '.HED':
+                raise CustomException("'{}' must be a .hed file".format(path))
+            files.append([path.read_bytes(), open(path.with_suffix('.mrg'), 'rb'),
+                          path.with_suffix('.nam').read_bytes() if path.with_suffix('.nam').is_file() else b''])
+    except Exception as exc:
+        print("ERR: [{1}] failed to process \"{0}\" - {2}".format(path, type(exc).__name__, str(exc)),
+              file=stderr)
+        sys.exit(1)
+
+    (old_hed, old_mrgfile, old_nam), (new_hed, new_mrgfile, new_nam) = files
+    old_mrg = map_file(old_mrgfile)
+    new_mrg = map_file(new_mrgfile)
+    entry_length = hed_record_length(new_hed)
+    nrecords = nsectors = 0
+    try:
+        with open(args.output, 'wb') as patchfile:
+            patchfile.write(pack(PATCH_HEADER, PATCH_MAGIC, PATCH_VERSION, len(old_hed), len(new_hed), len(old_mrg),
+                                 len(new_mrg), len(old_nam), len(new_nam), zlib.crc32(old_hed)))
+
+            def write_blocks(tag, old, new, unit):
+                count = 0
+                for start, end in changed_ranges(old, new, unit):
+                    count += (end - start + unit - 1) // unit
+                    for pos in range(start, end, PATCH_BLOCK_SIZE):
+                        data = new[pos:min(end, pos + PATCH_BLOCK_SIZE)]
+                        patchfile.write(pack(PATCH_BLOCK, tag, pos, len(data),
+                                             zlib.crc32(old[pos:pos + len(data)]), zlib.crc32(data)))
+                        patchfile.write(data)
+                return count
+
+            nrecords = write_blocks(b'HED ', old_hed, new_hed, entry_length)
+            nsectors = write_blocks(b'MRG ', old_mrg, new_mrg, 0x800)
+            if old_nam != new_nam:
+                # small, always shipped whole; a removed .nam has no block and a new size of 0
+                write_blocks(b'NAM ', b'', new_nam, PATCH_BLOCK_SIZE)
+    except Exception as exc:
+        print("ERR: [{1}] failed to write patch \"{0}\" - {2}".format(args.output, type(exc).__name__, str(exc)),
+              file=stderr)
+        sys.exit(1)
+    finally:
+        for mapped in (old_mrg, new_mrg):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        old_mrgfile.close()
+        new_mrgfile.close()
+
+    write_line('-')
+    print("| Changed: {0} .hed records, {1} .mrg sectors{2}".format(
+        nrecords, nsectors, ", .nam" if old_nam != new_nam else ""), file=stderr)
+    print("| Patch: {0} b".format(os.path.getsize(args.output)), file=stderr)
+    write_line('=')
+    print('Output: {0}'.format(args.output), file=stderr)
+
+
+def read_patch_blocks(patchfile, with_data):
+    """Yield (tag, position, size, crc32 before, crc32 of data, data or None) of each block, from the first one"""
+    patchfile.seek(calcsize(PATCH_HEADER))
+    while True:
+        header = patchfile.read(calcsize(PATCH_BLOCK))
+        if len(header) == 0:
+            return
+        if len(header) != calcsize(PATCH_BLOCK):
+            raise CustomException("patch is truncated")
+        tag, position, size, old_crc, new_crc = unpack(PATCH_BLOCK, header)
+        if tag not in PATCH_TAGS:
+            raise CustomException("unknown patch block '{0}'".format(tag))
+        if with_data:
+            data = patchfile.read(size)
+            if len(data) != size or zlib.crc32(data) != new_crc:
+                raise CustomException("patch block at {0:08X} is damaged".format(patchfile.tell() - len(data)))
+            yield tag, position, size, old_crc, new_crc, data
+        else:
+            patchfile.seek(size, 1)
+            yield tag, position, size, old_crc, new_crc, None
+
+
+def apply_verb(args):
+    in_hed = Path(args.subject)
+    targets = {}
+    try:
+        if str.upper(in_hed.suffix) != '.HED':
+            raise CustomException("'{}' must be a .hed file".format(args.subject))
+        patchfile = open(args.patch, 'rb')
+        magic, version, old_hed_size, new_hed_size, old_mrg_size, new_mrg_size, old_nam_size, new_nam_size, \
+            old_hed_crc = unpack(PATCH_HEADER, patchfile.read(calcsize(PATCH_HEADER)))
+        if magic != PATCH_MAGIC or version != PATCH_VERSION:
+            raise CustomException("'{0}' is not a hedutil patch".format(args.patch))
+        hed = in_hed.read_bytes()
+        if len(hed) != old_hed_size or zlib.crc32(hed) != old_hed_crc:
+            raise CustomException(".hed does not match the original of this patch (already applied?)")
+        del hed
+        if in_hed.with_suffix('.mrg').stat().st_size != old_mrg_size:
+            raise CustomException(".mrg size does not match the original of this patch")
+        nam_path = in_hed.with_suffix('.nam')
+        if (nam_path.stat().st_size if nam_path.is_file() else 0) != old_nam_size:
+            raise CustomException(".nam size does not match the original of this patch")
+        for tag in (b'HED ', b'MRG '):
+            targets[tag] = open(in_hed.with_suffix(PATCH_TAGS[tag]), 'r+b')
+
+        # check everything before writing anything: patch integrity and the original ranges
+        nblocks = 0
+        has_nam = False
+        for tag, position, size, old_crc, new_crc, data in read_patch_blocks(patchfile, True):
+            has_nam = has_nam or tag == b'NAM '
+            if tag != b'NAM ':
+                f = targets[tag]
+                f.seek(position)
+                if zlib.crc32(f.read(size)) != old_crc:
+                    raise CustomException("{0} range {1:08X}-{2:08X} differs from the original of this patch".format(
+                        PATCH_TAGS[tag], position, position + size))
+            nblocks += 1
+    except Exception as exc:
+        print("ERR: [{1}] failed to apply \"{0}\" - {2}".format(args.patch, type(exc).__name__, str(exc)),
+              file=stderr)
+        sys.exit(1)
+
+    try:
+        if has_nam:
+            targets[b'NAM '] = open(nam_path, 'wb')  # shipped whole
+        elif old_nam_size and not new_nam_size:
+            nam_path.unlink()  # removed from the patched archive
+        for tag, position, size, old_crc, new_crc, data in read_patch_blocks(patchfile, True):
+            f = targets[tag]
+            f.seek(position)
+            f.write(data)
+        targets[b'HED '].truncate(new_hed_size)
+        targets[b'MRG '].truncate(new_mrg_size)
+    except Exception as exc:
+        print("ERR: [{1}] failed to apply \"{0}\", the archive is damaged - {2}".format(
+            args.patch, type(exc).__name__, str(exc)), file=stderr)
+        sys.exit(2)
+    finally:
+        for f in targets.values():
+            f.close()
+        patchfile.close()
+
+    write_line('-')
+    print("| Applied: {0} blocks".format(nblocks), file=stderr)
+    write_line('=')
+    print('Output: {0}'.format(in_hed), file=stderr)
+
+
+#############################################################################
+# index verb #
+##############
+INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, kind TEXT NOT NULL, signature TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS entries (
+    archive_id INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE, idx INTEGER NOT NULL, name TEXT,
+    offset INTEGER NOT NULL, size INTEGER NOT NULL, magic BLOB, type TEXT, hash TEXT, PRIMARY KEY (archive_id, idx));
+CREATE INDEX IF NOT EXISTS entries_name ON entries(name);
+CREATE INDEX IF NOT EXISTS entries_size ON entries(size);
+CREATE INDEX IF NOT EXISTS entries_hash ON entries(hash);
+'''
+ENTRY_TYPES = {b'mrgd00': 'MZP', b'MZX0': 'MZX', b'RIFF': 'RIFF', b'\x80\x00': 'AHX', b'\x89PNG': 'PNG',
+               b'MRG.NAM': 'NAM'}
+
+
+def entry_type(magic):
+    for signature, name in ENTRY_TYPES.items():
+        if magic.startswith(signature):
+            return name
+    return None
+
+
+def find_containers(roots):
+    """Yield (kind, path) of the .hed triples and mrgd00 containers in roots"""
+    for root in map(Path, roots):
+        paths = [root] if root.is_file() else sorted(path for path in root.rglob('*') if path.is_file())
+        for path in paths:
+            suffix = str.upper(path.suffix)
+            if suffix == '.HED' and path.with_suffix('.mrg').is_file():
+                yield 'hed', path
+            elif suffix in ('.MRG', '.MZP'):
+                with open(path, 'rb') as f:
+                    if f.read(6) == b'mrgd00':
+                        yield 'mrgd00', path
+
+
+def container_signature(kind, path):
+    members = [path] if kind == 'mrgd00' else [path, path.with_suffix('.nam'), path.with_suffix('.mrg')]
+    return ' '.join('{0}:{1}'.format(st.st_size, st.st_mtime_ns) for st in (os.stat(p) for p in members if p.exists()))
+
+
+def container_entries(kind, path):
+    """Yield (idx, name, offset, size, magic, hash) of each entry of a container"""
+    if kind == 'hed':
+        with HedArchive(path) as archive:
+            for idx in range(len(archive)):
+                with archive.read(idx) as view:
+                    yield (idx, archive.name(idx), archive.offsets[idx], archive.sizes[idx], bytes(view[:8]),
+                           hashlib.blake2b(view, digest_size=16).hexdigest())
+        return
+    with open(path, 'rb') as f:
+        data = map_file(f)
+        try:
+            with memoryview(data) as view:
+                for idx, (offset, size) in enumerate(mrgd00_entries(data)):
+                    with view[offset:offset + size] as entry:
+                        yield (idx, None, offset, size, bytes(entry[:8]),
+                               hashlib.blake2b(entry, digest_size=16).hexdigest())
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
+def update_index(db, roots):
+    """Rescan the containers of roots whose files changed, forget those that disappeared. Return counts."""
+    nscanned = nupdated = 0
+    seen = set()
+    for kind, path in find_containers(roots):
+        key = str(path.resolve())
+        seen.add(key)
+        nscanned += 1
+        signature = container_signature(kind, path)
+        row = db.execute('SELECT id, signature FROM archives WHERE path = ?', (key,)).fetchone()
+        if row is not None and row[1] == signature:
+            continue
+        print("|- {0}".format(path), file=stderr)
+        with db:
+            if row is not None:
+                db.execute('DELETE FROM archives WHERE id = ?', (row[0],))
+            archive_id = db.execute('INSERT INTO archives (path, kind, signature) VALUES (?, ?, ?)',
+                                    (key, kind, signature)).lastrowid
+            db.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           ((archive_id, idx, name, offset, size, magic, entry_type(magic), digest)
+                            for idx, name, offset, size, magic, digest in container_entries(kind, path)))
+        nupdated += 1
+
+    # containers under the scanned roots that are gone
+    nremoved = 0
+    prefixes = [str(Path(root).resolve()) for root in roots]
+    with db:
+        for archive_id, key in db.execute('SELECT id, path FROM archives').fetchall():
+            if key not in seen and any(key == prefix or key.startswith(prefix + os.sep) for prefix in prefixes):
+                db.execute('DELETE FROM archives WHERE id = ?', (archive_id,))
+                nremoved += 1
+    return nscanned, nupdated, nremoved
+
+
+def index_verb(args):
+    try:
+        db = sqlite3.connect(args.database)
+        db.execute('PRAGMA foreign_keys = ON')
+        db.executescript(INDEX_SCHEMA)
+        write_line('-')
+        if not args.no_scan:
+            nscanned, nupdated, nremoved = update_index(db, args.roots)
+            print("| Containers: {0} found, {1} indexed, {2} removed".format(nscanned, nupdated, nremoved),
+                  file=stderr)
+        narchives, nentries = db.execute('SELECT (SELECT COUNT(*) FROM archives), COUNT(*) FROM entries').fetchone()
+        print("| Database: {0} containers, {1} entries".format(narchives, nentries), file=stderr)
+        write_line('=')
+
+        if args.query is not None or args.type is not None or args.min_size is not None:
+            rows = db.execute('SELECT archives.path, idx, name, size, type, hash FROM entries '
+                              'JOIN archives ON archives.id = archive_id WHERE COALESCE(name, \'\') GLOB ? AND '
+                              'COALESCE(type, \'\') GLOB ? AND size >= ? ORDER BY archives.path, idx',
+                              (args.query or '*', args.type or '*', args.min_size or 0))
+            for row in rows:
+                print('{0}\t{1}\t{2}\t{3}\t{4}\t{5}'.format(*row))
+        db.close()
+    except Exception as exc:
+        print("ERR: [{1}] failed to index into \"{0}\" - {2}".format(args.database, type(exc).__name__, str(exc)),
+              file=stderr)
+        sys.exit(1)
 
 
 ############
@@ -502,9 +1569,6 @@ def repack_verb(args):
 
 if __name__ == '__main__':
 
-    yaml.add_constructor(u'tag:yaml.org,2002:seq', ordereddict_constructor)
-    yaml.add_representer(OrderedDict, represent_ordereddict)
-
     parser, args = parse_args()
     if args.subcommand == "unpack":
         unpack_verb(args)
@@ -512,6 +1576,16 @@ if __name__ == '__main__':
         replace_verb(args)
     elif args.subcommand == "repack":
         repack_verb(args)
+    elif args.subcommand == "compact":
+        compact_verb(args)
+    elif args.subcommand == "convert":
+        convert_verb(args)
+    elif args.subcommand == "index":
+        index_verb(args)
+    elif args.subcommand == "diff":
+        diff_verb(args)
+    elif args.subcommand == "apply":
+        apply_verb(args)
     else:
         parser.print_usage()
         sys.exit(20)
@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+#
+# MZP Builder version 1.0
+# comes with ABSOLUTELY NO WARRANTY.
+#
+# PNG to MZP image encoder, the reverse of _extract_mzp.py
+# For more information, see Specifications/mzp_format.md
+#
+# The image layout (size, tiles, crop, bitmap type and depth, palette) is
+# taken from a template MZP, normally the file the PNG was extracted from.
+
+import os
+import sys
+import glob
+import time
+import zlib
+import argparse
+from sys import stderr
+from itertools import repeat
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from struct import pack, unpack, unpack_from
+from mzx.comp_mzx0 import compress, DEFAULT_LEVEL
+from mzputil import mrgd00_entries, byte_table, or_planes
+
+try:
+    import numpy as np
+except ImportError:  # optional, the conversions fall back to lookup tables
+    np = None
+
+
+class CustomException(Exception):
+    pass
+
+
+# outcome of process_path, picklable so that it can come back from a worker process
+BuildResult = namedtuple('BuildResult', 'source target tiles outlen warnings status error')
+PngImage = namedtuple('PngImage', 'width height pixels palette')
+MzpTemplate = namedtuple('MzpTemplate', 'descriptor width height tile_width tile_height tile_x_count tile_y_count '
+                                        'bmp_type bmp_depth tile_crop bitmap_bpp palette_count swizzled')
+
+MZP_SIGNATURE = b'mrgd00'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+ENTRY_ALIGN = 8  # data of every container entry starts on this boundary
+
+
+# 24bpp to 16bpp plane (P, Q bytes) + offset plane, the inverse of _extract_mzp_tiles.convert_truecolor:
+# P = (g & 0x1c) << 3 | b >> 3, Q = r & 0xf8 | g >> 5, ofs = (r & 0x7) << 5 | (g & 0x3) << 3 | b & 0x7
+P_FROM_G = byte_table(lambda g: (g & 0x1c) << 3)
+P_FROM_B = byte_table(lambda b: b >> 3)
+Q_FROM_R = byte_table(lambda r: r & 0xf8)
+Q_FROM_G = byte_table(lambda g: g >> 5)
+OFS_FROM_R = byte_table(lambda r: (r & 0x7) << 5)
+OFS_FROM_G = byte_table(lambda g: (g & 0x3) << 3)
+OFS_FROM_B = byte_table(lambda b: b & 0x7)
+HIGH_NIBBLE = byte_table(lambda i: (i & 0x0F) << 4)
+
+
+#############################################################################
+# PNG reader #
+##############
+def read_png(path):
+    """
+    Decode a non-interlaced PNG of any colour type. Palette images keep their indices (one byte per pixel) and
+    come with a list of RGBA palette entries, any other image is converted to RGBA.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:8] != PNG_SIGNATURE:
+        raise CustomException("'{0}' is not a PNG file".format(path))
+    pos = 8
+    header = plte = trns = None
+    idat = []
+    while pos < len(data):
+        length, kind = unpack_from('>I4s', data, pos)
+        chunk = data[pos + 8:pos + 8 + length]
+        crc, = unpack_from('>I', data, pos + 8 + length)
+        if crc != zlib.crc32(kind + chunk):
+            raise CustomException("bad CRC in {0} chunk".format(kind.decode('ASCII', 'replace')))
+        if kind == b'IHDR':
+            header = unpack('>IIBBBBB', chunk)
+        elif kind == b'PLTE':
+            plte = chunk
+        elif kind == b'tRNS':
+            trns = chunk
+        elif kind == b'IDAT':
+            idat.append(chunk)
+        elif kind == b'IEND':
+            break
+        pos += 12 + length
+    if header is None:
+        raise CustomException("missing IHDR chunk")
+    width, height, depth, color, compression, filtering, interlace = header
+    if color not in PNG_CHANNELS or interlace or depth not in ((8, 16) if color in (2, 4, 6) else (1, 2, 4, 8, 16)):
+        raise CustomException("unsupported PNG format (colour type {0}, depth {1}, interlace {2})".format(
+            color, depth, interlace))
+
+    channels = PNG_CHANNELS[color]
+    stride = (width * channels * depth + 7) // 8
+    raw = unfilter(zlib.decompress(b''.join(idat)), height, stride, max(1, channels * depth // 8))
+    samples = to_8bit(raw, width, height, stride, channels, depth, color == 3)
+    count = width * height
+
+    if color == 3:
+        if plte is None:
+            raise CustomException("missing PLTE chunk")
+        alphas = (trns or b'') + b'\xFF' * 0x100
+        palette = [plte[i * 3:i * 3 + 3] + alphas[i:i + 1] for i in range(len(plte) // 3)]
+        return PngImage(width, height, samples, palette)
+
+    pixels = bytearray(b'\xFF' * (count * 4))
+    if color in (0, 4):
+        for channel in range(3):
+            pixels[channel::4] = samples[0::channels]
+    else:
+        for channel in range(3):
+            pixels[channel::4] = samples[channel::channels]
+    if color in (4, 6):
+        pixels[3::4] = samples[channels - 1::channels]
+    elif trns:  # colour key
+        scale = 0xFF // ((1 << depth) - 1) if depth < 8 else 1
+        key = bytes(trns[i] if depth == 16 else trns[i + 1] * scale for i in range(0, len(trns), 2))
+        key = (key * 3 if color == 0 else key) + b'\xFF'
+        for offset in range(0, count * 4, 4):
+            if pixels[offset:offset + 4] == key:
+                pixels[offset + 3] = 0
+    return PngImage(width, height, bytes(pixels), None)
+
+
+def unfilter(data, height, stride, bpp):
+    """Undo the per-scanline PNG filters, return the scanlines without their filter bytes."""
+    out = bytearray(height * stride)
+    prev = bytes(stride)
+    mask = int.from_bytes(b'\x7F' * stride, 'little')
+    for y in range(height):
+        pos = y * (stride + 1)
+        ftype = data[pos]
+        line = data[pos + 1:pos + 1 + stride]
+        if ftype == 0:
+            row = line
+        elif ftype == 2:  # up, a bytewise add without carries across bytes
+            a, b = int.from_bytes(line, 'little'), int.from_bytes(prev, 'little')
+            row = (((a & mask) + (b & mask)) ^ ((a ^ b) & ~mask)).to_bytes(stride, 'little')
+        elif ftype == 1 and np is not None:  # sub, a running sum of every byte of a pixel
+            row = np.cumsum(np.frombuffer(line, np.uint8).reshape(-1, bpp), axis=0, dtype=np.uint8).tobytes()
+        elif ftype in (1, 3, 4):
+            row = bytearray(line)
+            for i in range(stride):
+                left = row[i - bpp] if i >= bpp else 0
+                if ftype == 1:
+                    pred = left
+                elif ftype == 3:
+                    pred = (left + prev[i]) >> 1
+                else:
+                    up = prev[i]
+                    upleft = prev[i - bpp] if i >= bpp else 0
+                    p = left + up - upleft
+                    pa, pb, pc = abs(p - left), abs(p - up), abs(p - upleft)
+                    pred = left if pa <= pb and pa <= pc else up if pb <= pc else upleft
+                row[i] = (row[i] + pred) & 0xFF
+        else:
+            raise CustomException("bad filter type {0} on row {1}".format(ftype, y))
+        out[y * stride:(y + 1) * stride] = row
+        prev = row
+    return out
+
+
+def to_8bit(raw, width, height, stride, channels, depth, indexed):
+    """One byte per sample: 16-bit samples keep their high byte, packed samples are unpacked (and scaled to 0-255
+    unless they are palette indices)."""
+    if depth == 8:
+        return bytes(raw)
+    if depth == 16:
+        return bytes(raw[0::2])
+    per_byte = 8 // depth
+    scale = 1 if indexed else 0xFF // ((1 << depth) - 1)
+    unpacked = [byte_table(lambda i: ((i >> (8 - depth * (k + 1))) & ((1 << depth) - 1)) * scale)
+                for k in range(per_byte)]
+    samples = bytearray(height * width)
+    row = bytearray(stride * per_byte)
+    for y in range(height):
+        line = raw[y * stride:(y + 1) * stride]
+        for k in range(per_byte):
+            row[k::per_byte] = line.translate(unpacked[k])
+        samples[y * width:(y + 1) * width] = row[:width]
+    return bytes(samples)
+
+
+#############################################################################
+# MZP layout #
+##############
+def mrgd00_container(entries):
+    """A mrgd00 container holding entries in order, laid out as _extract_mzp.ArchiveEntry reads it"""
+    header = bytearray(MZP_SIGNATURE + pack('<H', len(entries)))
+    body = bytearray()
+    for entry in entries:
+        body += bytes(-len(body) % ENTRY_ALIGN)
+        sector_offset, offset = divmod(len(body), 0x800)
+        size = len(entry)
+        # sectors covered by the size, (upper - 1) // 0x20 must give the 64 KiB units of the size
+        sector_size_upper_boundary = (size >> 16) * 0x20 + max(1, ((size & 0xFFFF) + 0x7FF) // 0x800)
+        if sector_offset > 0xFFFF or sector_size_upper_boundary > 0xFFFF:
+            raise CustomException("data does not fit in a mrgd00 container ({0}b)".format(len(body) + size))
+        header += pack('<HHHH', sector_offset, offset, sector_size_upper_boundary, size & 0xFFFF)
+        body += entry
+    return bytes(header + body)
+
+
+def bitmap_format(bmp_type, bmp_depth):
+    """(bits per pixel, palette entries, RGBATim2 palette) of a supported MZP bitmap, as MzpFile decodes it"""
+    if bmp_type == 0x01:
+        if bmp_depth in [0x00, 0x10]:
+            return 4, 0x10, False
+        elif bmp_depth in [0x01, 0x11, 0x91]:
+            return 8, 0x100, True
+    elif bmp_type == 0x08 and bmp_depth == 0x14:
+        return 24, 0, False
+    elif bmp_type == 0x0B and bmp_depth == 0x14:
+        return 32, 0, False
+    raise CustomException("unsupported bitmap type 0x{0:02X} depth 0x{1:02X}".format(bmp_type, bmp_depth))
+
+
+def read_template(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:6] != MZP_SIGNATURE:
+        raise CustomException("template '{0}' is not a mrgd00 container".format(path))
+    offset, size = mrgd00_entries(data)[0]
+    descriptor = data[offset:offset + size]
+    fields = unpack_from('<HHHHHHHBB', descriptor)
+    template = MzpTemplate(descriptor, *fields, *bitmap_format(fields[6], fields[7]))
+    if len(descriptor) < 0x10 + template.palette_count * 4:
+        raise CustomException("template '{0}' has a truncated palette".format(path))
+    return template
+
+
+def swizzle_palette(entries):
+    """Swap the 2nd and 3rd run of 8 entries in every 32 (RGBATim2 layout), its own inverse"""
+    swizzled = []
+    for block in range(0, len(entries), 0x20):
+        for run in (0, 2, 1, 3):
+            swizzled += entries[block + run * 8:block + run * 8 + 8]
+    return swizzled
+
+
+def png_alpha(alpha):
+    return (alpha << 1) + (alpha >> 6) if alpha < 0x80 else 255
+
+
+def decode_palette(template):
+    """Palette of the template as RGBA entries in index order, as they appear in the extracted PNG"""
+    stored = [template.descriptor[0x10 + i * 4:0x14 + i * 4] for i in range(template.palette_count)]
+    if template.swizzled:
+        stored = swizzle_palette(stored)
+    return [entry[:3] + bytes([png_alpha(entry[3])]) for entry in stored], stored
+
+
+def encode_palette(palette, template):
+    """Stored palette bytes for RGBA entries in index order, entries equal to the template keep its bytes"""
+    decoded, stored = decode_palette(template)
+    entries = [old if new == current else new[:3] + bytes([new[3] >> 1])
+               for current, old, new in zip(decoded, stored, list(palette) + decoded[len(palette):])]
+    if template.swizzled:
+        entries = swizzle_palette(entries)
+    return b''.join(entries)
+
+
+#############################################################################
+# pixel conversion #
+####################
+def map_to_palette(pixels, palette):
+    """Indices of the nearest palette entry for RGBA pixels, return (indices, number of inexact colours)"""
+    lookup = {}
+    for index, entry in enumerate(palette):
+        lookup.setdefault(int.from_bytes(entry, 'little'), index)
+    colors = np.frombuffer(pixels, '<u4') if np is not None else memoryview(pixels).cast('I')
+    if np is not None:
+        unique, inverse = np.unique(colors, return_inverse=True)
+        unique = unique.tolist()
+    else:
+        unique = set(colors)
+    missing = [color for color in unique if color not in lookup]
+    if missing:
+        entries = [tuple(entry) for entry in palette]
+        for color in missing:
+            rgba = color.to_bytes(4, 'little')
+            lookup[color] = min(range(len(entries)),
+                                key=lambda i: sum((a - b) * (a - b) for a, b in zip(rgba, entries[i])))
+    if np is not None:
+        indices = np.array([lookup[color] for color in unique], np.uint8)[inverse.reshape(-1)].tobytes()
+    else:
+        indices = bytes(map(lookup.__getitem__, colors))
+    return indices, len(missing)
+
+
+def pack_4bpp(tile):
+    """Two palette indices per byte, low nibble first"""
+    if np is not None:
+        pixels = np.frombuffer(tile, np.uint8)
+        return ((pixels[0::2] & 0x0F) | (pixels[1::2] << 4)).tobytes()
+    return or_planes(tile[0::2], tile[1::2].translate(HIGH_NIBBLE))
+
+
+def split_truecolor(tile, alpha):
+    """16bpp plane, offset plane and (for 0x0B) alpha plane of an RGBA tile"""
+    r, g, b = tile[0::4], tile[1::4], tile[2::4]
+    if np is not None:
+        r, g, b = (np.frombuffer(plane, np.uint8) for plane in (r, g, b))
+        plane16 = np.empty((len(r), 2), np.uint8)
+        plane16[:, 0] = ((g & 0x1c) << 3) | (b >> 3)
+        plane16[:, 1] = (r & 0xf8) | (g >> 5)
+        offsets = ((r & 0x7) << 5) | ((g & 0x3) << 3) | (b & 0x7)
+        planes = [plane16.tobytes(), offsets.tobytes()]
+    else:
+        plane16 = bytearray(len(r) * 2)
+        plane16[0::2] = or_planes(g.translate(P_FROM_G), b.translate(P_FROM_B))
+        plane16[1::2] = or_planes(r.translate(Q_FROM_R), g.translate(Q_FROM_G))
+        planes = [bytes(plane16), or_planes(r.translate(OFS_FROM_R), g.translate(OFS_FROM_G), b.translate(OFS_FROM_B))]
+    if alpha:
+        planes.append(tile[3::4])
+    return b''.join(planes)
+
+
+def cut_tiles(pixels, template, bytesprepx):
+    """
+    Yield the tiles of the cropped image in MzpFile order. The crop margins and the parts of the last tiles past the
+    image repeat the nearest edge pixel, like the neighbouring tiles they overlap.
+    """
+    crop = template.tile_crop
+    width = template.width - template.tile_x_count * crop * 2
+    height = template.height - template.tile_y_count * crop * 2
+    cropped_width = template.tile_width - crop * 2
+    cropped_height = template.tile_height - crop * 2
+    pad_right = (template.tile_x_count - 1) * cropped_width + template.tile_width - crop - width
+    pad_bottom = (template.tile_y_count - 1) * cropped_height + template.tile_height - crop - height
+    stride = width * bytesprepx
+
+    rows = []
+    for y in range(height):
+        row = pixels[y * stride:(y + 1) * stride]
+        rows.append(row[:bytesprepx] * crop + row + row[-bytesprepx:] * pad_right)
+    rows = rows[:1] * crop + rows + rows[-1:] * pad_bottom
+
+    tile_stride = template.tile_width * bytesprepx
+    for y in range(template.tile_y_count):
+        band = rows[y * cropped_height:y * cropped_height + template.tile_height]
+        for x in range(template.tile_x_count):
+            left = x * cropped_width * bytesprepx
+            yield b''.join(row[left:left + tile_stride] for row in band)
+
+
+def compress_tile(tile, bitmap_bpp, level):
+    if bitmap_bpp == 4:
+        tile = pack_4bpp(tile)
+    elif bitmap_bpp in [24, 32]:
+        tile = split_truecolor(tile, bitmap_bpp == 32)
+    return compress(tile, False, level)
+
+
+def encode_mzp(image, template, level, executor=None):
+    """Return (mrgd00 container, number of tiles, warnings) of image laid out like template"""
+    warnings = []
+    width = template.width - template.tile_x_count * template.tile_crop * 2
+    height = template.height - template.tile_y_count * template.tile_crop * 2
+    if (image.width, image.height) != (width, height):
+        raise CustomException("image is {0}x{1}, the template expects {2}x{3}".format(
+            image.width, image.height, width, height))
+
+    descriptor = template.descriptor
+    if template.palette_count:
+        if image.palette is not None:
+            pixels = image.pixels
+            highest = max(pixels) if pixels else 0
+            if highest >= template.palette_count:
+                raise CustomException("palette index {0} does not fit in a {1}-colour palette".format(
+                    highest, template.palette_count))
+            palette = encode_palette(image.palette[:template.palette_count], template)
+            descriptor = descriptor[:0x10] + palette + descriptor[0x10 + len(palette):]
+        else:
+            pixels, inexact = map_to_palette(image.pixels, decode_palette(template)[0])
+            if inexact:
+                warnings.append("{0} colour(s) not in the template palette mapped to the nearest entry".format(
+                    inexact))
+        bytesprepx = 1
+    elif image.palette is not None:
+        pixels = b''.join(map(image.palette.__getitem__, image.pixels))
+        bytesprepx = 4
+    else:
+        pixels = image.pixels
+        bytesprepx = 4
+
+    tiles = list(cut_tiles(pixels, template, bytesprepx))
+    if executor is None:
+        blocks = [compress_tile(tile, template.bitmap_bpp, level) for tile in tiles]
+    else:
+        blocks = list(executor.map(compress_tile, tiles, repeat(template.bitmap_bpp), repeat(level)))
+    return mrgd00_container([descriptor] + blocks), len(tiles), warnings
+
+
+#############################################################################
+# build verb #
+##############
+def template_path(sourcepath, args):
+    if args.template is not None and os.path.isfile(args.template):
+        return args.template
+    directory = args.template if args.template is not None else os.path.dirname(sourcepath)
+    stem = os.path.splitext(os.path.basename(sourcepath))[0]
+    for suffix in ('.MZP', '.mzp'):
+        candidate = os.path.join(directory, stem + suffix)
+        if os.path.isfile(candidate):
+            return candidate
+    raise CustomException("no template '{0}.MZP' in \"{1}\"".format(stem, directory or '.'))
+
+
+def process_paths(sourcepaths, args):
+    """Yield the result of every path in sourcepaths order, worked out by args.jobs processes."""
+    jobs = args.jobs or os.cpu_count() or 1
+    if jobs > 1 and len(sourcepaths) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            yield from executor.map(process_path, sourcepaths, [args] * len(sourcepaths))
+    elif jobs > 1 and sourcepaths:  # a single image, its tiles are compressed in parallel
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            yield process_path(sourcepaths[0], args, executor)
+    else:
+        for sourcepath in sourcepaths:
+            yield process_path(sourcepath, args)
+
+
+def process_path(sourcepath, args, executor=None):
+    outpath = None
+    basename_mzp = os.path.splitext(os.path.basename(sourcepath))[0] + '.MZP'
+    tiles = outlen = None
+    warnings = []
+    try:
+        template = read_template(template_path(sourcepath, args))
+        image = read_png(sourcepath)
+        outdata, tiles, warnings = encode_mzp(image, template, args.level, executor)
+        outlen = len(outdata)
+        outpath = os.path.join(args.outputdir, basename_mzp)
+        with open(outpath, 'wb') as outfile:
+            outfile.write(outdata)
+        return BuildResult(sourcepath, basename_mzp, tiles, outlen, warnings, "OK", None)
+    except Exception as exc:
+        if outpath is not None and os.path.isfile(outpath):
+            try:
+                os.remove(outpath)
+            except Exception:
+                pass  # swallow
+        return BuildResult(sourcepath, basename_mzp, tiles, outlen, warnings, "ERR",
+                           "[{0}] {1}".format(type(exc).__name__, str(exc)))
+
+
+def print_result(result):
+    for warning in result.warnings:
+        print("WRN: \"{0}\" - {1}".format(result.source, warning), file=stderr)
+    print("* {0} => {1}: ".format(os.path.basename(result.source), result.target), end="")
+    if result.status == "OK":
+        print("{0} tiles {1}b [PASSED]".format(result.tiles, result.outlen))
+    else:
+        print("[FAILED]")
+        print("ERR: failed to process \"{0}\" - {1}".format(result.source, result.error), file=stderr)
+
+
+############
+# __main__ #
+############
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Encode one or several PNG images as MZP')
+    parser.add_argument('inputs', metavar='input_file', nargs='+', help='Input PNG file(s) or folder(s)')
+    parser.add_argument('-t', '--template',
+                        default=None, dest='template',
+                        help='Template MZP, or folder holding a <name>.MZP template per image '
+                             '(default: the folder of each image)')
+    parser.add_argument('-o', '--output-dir',
+                        default='50buildedmzp', dest='outputdir',
+                        help='Output directory (default: 50buildedmzp)')
+    parser.add_argument('-l', '--level',
+                        default=DEFAULT_LEVEL, dest='level', type=int, choices=range(4),
+                        help='Compression level: 0 store, 1 greedy, 2 lazy, 3 optimal (default: {0})'.format(
+                            DEFAULT_LEVEL))
+    parser.add_argument('-j', '--jobs',
+                        default=1, dest='jobs', type=int,
+                        help='Number of worker processes, 0 for one per CPU; a single image is split by tiles '
+                             '(default: 1)')
+    args = parser.parse_args()
+
+    try:
+        os.makedirs(args.outputdir, exist_ok=True)
+    except Exception as exc:
+        print("ERR: [{1}] failed to create specified output directory \"{0}\" - {2}".format(
+            args.outputdir, type(exc).__name__, str(exc)), file=stderr)
+        sys.exit(1)
+
+    sourcepaths = []
+    for inpath in args.inputs:
+        if os.path.isdir(inpath):
+            sourcepaths.extend(sorted(glob.iglob(os.path.join(inpath, '*.png'))))
+        else:
+            sourcepaths.append(inpath)
+
+    start = time.perf_counter()
+    npassed = nfailed = 0
+    for result in process_paths(sourcepaths, args):
+        print_result(result)
+        if result.status != "OK":
+            nfailed += 1
+        else:
+            npassed += 1
+
+    print("Passed = {0}\nFailed = {1}".format(npassed, nfailed))
+    print("Elapsed {0:.2f}s".format(time.perf_counter() - start))
+    sys.exit(1 if nfailed else 0)
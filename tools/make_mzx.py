@@ -8,19 +8,84 @@ Usage:
 make_mzx.py 30insertedscript
 """
 
-import os, errno, io
+import os, errno
 import sys
 from sys import stderr
 from struct import unpack, pack
 import glob
 import re
-from mzx.comp_mzx0 import mzx0_compress
+import hashlib
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from mzx.comp_mzx0 import compress, DEFAULT_LEVEL, COMPRESSOR_VERSION
+from mzx.decomp_mzx0 import mzx0_decode
 
 
 class CustomException(Exception):
     pass
 
 
+# outcome of process_path, picklable so that it can come back from a worker process
+BuildResult = namedtuple('BuildResult', 'source target inlen outlen warnings status error cache verifytime')
+
+
+class BuildCache:
+    """
+    Content-addressed store of compressed scripts, keyed by the CP932 payload, compressor version and level.
+    Entries are plain files whose mtime is bumped on every hit, evict() drops the least recently used.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    @staticmethod
+    def key(payload, level, xorff):
+        digest = hashlib.sha1('MZX0:{0}:{1}:{2}:'.format(COMPRESSOR_VERSION, level, int(xorff)).encode('ascii'))
+        digest.update(payload)
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.MZX')
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        path = self.entry_path(key)
+        makedir(os.path.dirname(path))
+        temppath = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temppath, 'wb') as f:
+            f.write(data)
+        os.replace(temppath, path)  # atomic, concurrent jobs may store the same entry
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits max_size, return [count, bytes] removed."""
+        entries = []
+        total = 0
+        for path in glob.iglob(os.path.join(self.path, '*', '*.MZX')):
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        count = size = 0
+        for mtime, entry_size, path in entries:
+            if total - size <= self.max_size:
+                break
+            os.remove(path)
+            count += 1
+            size += entry_size
+        return [count, size]
+
+
 def makedir(dirname):
     try:
         os.makedirs(dirname)
@@ -31,27 +96,73 @@ def makedir(dirname):
             raise
 
 
-def process_directory(sourcedirpath, args, mask='*.txt'):
-    successful = failed = 0
-    for filepath in glob.iglob(os.path.join(sourcedirpath, mask)):
-        s = process_path(filepath, args)
-        if s != "OK":
-            failed += 1
+def first_mismatch(expected, actual):
+    """Offset of the first byte where actual differs from expected, None when they are equal."""
+    if expected == actual:
+        return None
+    size = min(len(expected), len(actual))
+    lo = 0
+    while size - lo > 0x100:  # bisect on slice compares, the matching prefix is usually long
+        mid = (lo + size) // 2
+        if expected[lo:mid] == actual[lo:mid]:
+            lo = mid
         else:
-            successful += 1
-    return [successful, failed]
+            size = mid
+    for offset in range(lo, size):
+        if expected[offset] != actual[offset]:
+            return offset
+    return size
+
+
+def verify_mzx(outdata, expected):
+    """Decode outdata in memory and compare it with expected, raise CustomException on the first difference."""
+    exlen = unpack('<L', outdata[4:8])[0]
+    if outdata[:4] != b'MZX0' or exlen != len(expected):
+        raise CustomException("verification failed - bad header (length {0}, expected {1})".format(exlen, len(expected)))
+    status, decoded = mzx0_decode(memoryview(outdata)[8:], exlen, xorff=True)
+    offset = first_mismatch(expected, decoded)
+    if offset is not None:
+        raise CustomException("verification failed - output differs at offset 0x{0:X}".format(offset))
+
+
+def process_paths(sourcepaths, args):
+    """Yield the result of every path in sourcepaths order, worked out by args.jobs processes."""
+    jobs = args.jobs or os.cpu_count() or 1
+    if jobs > 1 and len(sourcepaths) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            yield from executor.map(process_path, sourcepaths, [args] * len(sourcepaths))
+    else:
+        for sourcepath in sourcepaths:
+            yield process_path(sourcepath, args)
+
+
+def print_result(result):
+    for warning in result.warnings:
+        print("WRN: {0}".format(warning), file=stderr)
+    print("* {0} => {1}: ".format(os.path.basename(result.source), result.target), end="")
+    if result.status == "OK":
+        print("{0}b {1}b [PASSED]{2}{3}".format(
+            result.inlen, result.outlen, " (cached)" if result.cache == "hit" else "",
+            "" if result.verifytime is None else " (verified in {0:.1f}ms)".format(result.verifytime * 1000)))
+    else:
+        print("[FAILED]")
+        print("ERR: failed to process \"{0}\" - {1}".format(result.source, result.error), file=stderr)
 
 
 def process_path(sourcepath, args):
     infile = None
     outpath = None
+    basename_mzx = None
+    inlen = outlen = None
+    cachestatus = None
+    verifytime = None
+    warnings = []
     try:
         basename_src = os.path.basename(sourcepath)
 
         # using split() b/c source basename generally has multiple dots
         basename_inter = basename_src.split('.', 2)[0] + '.pre-comp.sjs'
         basename_mzx = basename_src.split('.', 2)[0] + '.MZX'  # using split() b/c it generally has multiple dots
-        print("* {0} => {1}: ".format(basename_src, basename_mzx), end="")
         if str.upper(os.path.splitext(basename_src)[1]) == '.MZX':
             raise CustomException("'{0}' is already a .MZX file".format(basename_src))
         outpath = os.path.join(args.outputdir, basename_mzx)
@@ -90,8 +201,8 @@ def process_path(sourcepath, args):
                 if len(l) > 0:
                     m = re.search(r'^~(.*)~$', l)
                     if m is None:
-                        print("WRN: \"{0}\" line {1} - {2}".format(sourcepath, lnum,
-                                                                   "text should be enclosed in ~~ " + l), file=stderr)
+                        warnings.append("\"{0}\" line {1} - {2}".format(sourcepath, lnum,
+                                                                        "text should be enclosed in ~~ " + l))
                     else:
                         processed_lines.append(m.group(1))
             lnum += 1
@@ -101,24 +212,33 @@ def process_path(sourcepath, args):
         with open(os.path.join(args.tempdir, basename_inter), 'wb') as interfile:
             interfile.write(resultbytes)
 
-        outdata = mzx0_compress(io.BytesIO(resultbytes), inlen, xorff=True)
+        outdata = None
+        if args.cachedir is not None:
+            cache = BuildCache(args.cachedir, args.cachesize)
+            cachekey = cache.key(resultbytes, args.level, True)
+            outdata = cache.get(cachekey)
+            cachestatus = "miss" if outdata is None else "hit"
+        if outdata is None:
+            outdata = compress(resultbytes, xorff=True, level=args.level)
         outlen = len(outdata)
+        if args.verify:
+            start = time.perf_counter()
+            verify_mzx(outdata, resultbytes)
+            verifytime = time.perf_counter() - start
+        if cachestatus == "miss":
+            cache.put(cachekey, outdata)  # only once verified, a bad stream must not be reused by later builds
         with open(outpath, 'wb') as outfile:
             outfile.write(outdata)
 
-        print("{0}b {1}b [PASSED]".format(inlen, outlen))
-        return "OK"
-    except CustomException as exc:
-        print("[FAILED]")
-        nfailed += 1
-        print("ERR: [{1}] failed to process \"{0}\" - {2}".format(sourcepath, type(exc).__name__, str(exc)),
-              file=stderr)
+        return BuildResult(sourcepath, basename_mzx, inlen, outlen, warnings, "OK", None, cachestatus, verifytime)
+    except Exception as exc:
         if outpath is not None and os.path.isfile(outpath):
             try:
                 os.remove(outpath)
             except Exception:
                 pass  # swallow
-        return "ERR"
+        return BuildResult(sourcepath, basename_mzx, inlen, outlen, warnings, "ERR",
+                           "[{0}] {1}".format(type(exc).__name__, str(exc)), cachestatus, verifytime)
     finally:
         if infile is not None:
             infile.close()
@@ -141,7 +261,24 @@ if __name__ == '__main__':
     parser.add_argument('-t', '--temp-dir',
                         default=None, dest='tempdir',
                         help='Temporary directory (default: 35precompscript)')
+    parser.add_argument('-l', '--level',
+                        default=DEFAULT_LEVEL, dest='level', type=int, choices=range(4),
+                        help='Compression level: 0 store, 1 greedy, 2 lazy, 3 optimal (default: {0})'.format(
+                            DEFAULT_LEVEL))
+    parser.add_argument('-j', '--jobs',
+                        default=1, dest='jobs', type=int,
+                        help='Number of worker processes, 0 for one per CPU (default: 1)')
+    parser.add_argument('-c', '--cache-dir',
+                        default=None, dest='cachedir',
+                        help='Build cache directory, e.g. 45mzxcache (default: no cache, always recompress)')
+    parser.add_argument('--cache-size',
+                        default=64, dest='cachesize', type=int,
+                        help='Build cache size limit in MiB, least recently used entries are evicted (default: 64)')
+    parser.add_argument('--verify',
+                        action='store_true', dest='verify',
+                        help='Decompress every output in memory and compare it with the uncompressed script')
     args = parser.parse_args()
+    args.cachesize *= 0x100000
     if args.outputdir is None:
         args.outputdir = "40buildedscript"
     if args.tempdir is None:
@@ -149,28 +286,39 @@ if __name__ == '__main__':
 
     dir = ""
     try:
-        for dir in [args.outputdir, args.tempdir]:
-            makedir(dir)
+        for dir in [args.outputdir, args.tempdir, args.cachedir]:
+            if dir is not None:
+                makedir(dir)
     except Exception as exc:
         print("ERR: [{1}] failed to create specified output directory \"{0}\" - {2}".format(dir, type(exc).__name__,
                                                                                             str(exc)), file=stderr)
         sys.exit(1)
 
-    npassed = nfailed = 0
-
+    sourcepaths = []
     for inpath in args.inputs:
         if os.path.isdir(inpath):
-            successful, failed = process_directory(inpath, args)
+            sourcepaths.extend(sorted(glob.iglob(os.path.join(inpath, '*.txt'))))
         else:
-            s = process_path(inpath, args)
-            if s != "OK":
-                successful = 0
-                failed = 1
-            else:
-                successful = 1
-                failed = 0
+            sourcepaths.append(inpath)
 
-        npassed += successful
-        nfailed += failed
+    npassed = nfailed = nhits = nmisses = 0
+    verifytime = 0.0
+    for result in process_paths(sourcepaths, args):
+        print_result(result)
+        if result.status != "OK":
+            nfailed += 1
+        else:
+            npassed += 1
+        if result.cache == "hit":
+            nhits += 1
+        elif result.cache == "miss":
+            nmisses += 1
+        if result.verifytime is not None:
+            verifytime += result.verifytime
 
     print("Passed = {0}\nFailed = {1}".format(npassed, nfailed))
+    if args.verify:
+        print("Verified in {0:.1f}ms".format(verifytime * 1000))
+    if args.cachedir is not None:
+        nevicted, evictedsize = BuildCache(args.cachedir, args.cachesize).evict()
+        print("Cache: {0} hits, {1} misses, {2} evicted ({3}b)".format(nhits, nmisses, nevicted, evictedsize))
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+#
+# Helpers shared by the MZP tools (_extract_mzp_tiles, make_mzp) and hedutil
+# comes with ABSOLUTELY NO WARRANTY.
+#
+# For more information, see Specifications/mzp_format.md
+
+from struct import unpack_from, iter_unpack
+
+
+def mrgd00_entries(data):
+    """(offset, size) of each entry of a whole mrgd00 container, laid out as unpack_allsrc.ArchiveEntry reads it"""
+    count, = unpack_from('<H', data, 6)
+    data_start = 8 + count * 8
+    entries = []
+    for sector_offset, offset, sector_size_upper_boundary, size in iter_unpack('<HHHH', data[8:data_start]):
+        entries.append((data_start + sector_offset * 0x800 + offset,
+                        (sector_size_upper_boundary - 1) // 0x20 * 0x10000 + size))
+    return entries
+
+
+def byte_table(func):
+    """256-byte bytes.translate table mapping each byte value i to func(i)"""
+    return bytes(func(i) for i in range(0x100))
+
+
+def or_planes(*planes):
+    """Bitwise OR of equally sized byte planes, as one big-int operation"""
+    value = 0
+    for plane in planes:
+        value |= int.from_bytes(plane, 'little')
+    return value.to_bytes(len(planes[0]), 'little')
@@ -0,0 +1,2 @@
+# XOR-with-0xFF key of script .MZX literals, for bytes.translate
+XORFF_TABLE = bytes(byte ^ 0xFF for byte in range(0x100))
@@ -1,32 +1,397 @@
 #!/usr/bin/env python
 
-from struct import unpack, pack
+# MZX Compress Library
+# Pure Python. Emits the four MZX0 commands understood by decomp_mzx0.
+#
+# Commands work on 2-byte words:
+#   RLE     (0) - repeat the last word 1..64 times
+#   BACKREF (1) - copy 1..64 words from 1..256 words back, one word at a time
+#   RINGBUF (2) - write one word from the 64-entry literal ring buffer
+#   LITERAL (3) - 1..64 plain words, each pushed into the ring buffer
+#
+# The decoder resets the last word (but not the ring buffer) at the first
+# command boundary after 0x1000 words, the encoder tracks the same counter.
+#
+# Compression levels:
+#   0 - store, literal commands only (default)
+#   1 - greedy hash-chain matching
+#   2 - lazy matching, defers a command when a literal and the command at
+#       the next word cost fewer bytes per word
+#   3 - optimal parse, shortest path over the command cost model
+#       (1 byte per command, +1 for a backreference, 2 bytes per literal word)
 
+from struct import pack
+from . import XORFF_TABLE
 
-def mzx0_compress(f, inlen, xorff=False):
-    """Compress a block of data.
+RING_SIZE = 0x40
+CLEAR_COUNT = 0x1000
+MAX_RUN = 0x40          # words per command
+MAX_DISTANCE = 0x100    # backreference window, in words
+MIN_MATCH = 2           # a 1-word backreference costs as much as a literal
+
+# bump whenever the compressed output of any level changes, build caches key on it
+COMPRESSOR_VERSION = 2
+
+LEVEL_STORE = 0
+LEVEL_GREEDY = 1
+LEVEL_LAZY = 2
+LEVEL_OPTIMAL = 3
+DEFAULT_LEVEL = LEVEL_STORE
+
+# hash chain candidates visited per position
+MAX_CHAIN = {LEVEL_GREEDY: 16, LEVEL_LAZY: 32, LEVEL_OPTIMAL: MAX_DISTANCE}
+# optimal parse refinements, ring buffer hits are predicted from the previous parse
+OPTIMAL_PASSES = 3
+
+
+def mzx0_compress(f, inlen, xorff=False, level=DEFAULT_LEVEL):
+    """Compress a block of data read from a file object.
+    """
+    return compress(f.read(inlen), xorff, level)
+
+
+def compress(data, xorff=False, level=DEFAULT_LEVEL) -> bytes:
+    """Compress a bytes-like object into a new MZX0 stream.
+    """
+    out = bytearray()
+    compress_into(data, out, xorff, level)
+    return bytes(out)
+
+
+def compress_many(buffers, xorff=False, level=DEFAULT_LEVEL) -> list:
+    """Compress each bytes-like object of buffers, the output buffer is reused between them.
+    """
+    results = []
+    out = bytearray()
+    for data in buffers:
+        compress_into(data, out, xorff, level)
+        results.append(bytes(out))
+        del out[:]
+    return results
+
+
+def compress_into(data, out: bytearray, xorff=False, level=DEFAULT_LEVEL) -> int:
+    """Append the MZX0 stream of a bytes-like object to out, return the number of bytes appended.
     """
-    dout = bytearray(b'MZX0')
-    dout.extend(pack('<L', inlen))
-
-    key = 0xFFFFFFFF if xorff else 0
-    while inlen >= 0x80:
-        # 0xFF literal, write plaintext input 0x80 bytes // 0xFF = 0xFC+0x03 // (0xFC >> 2 + 1) => 0x40 times 2-byte pairs
-        dout.extend(b'\xFF')
-        for i in range(0x20):
-            dout.extend(pack('<L', unpack('<L', f.read(0x4))[0] ^ key))
-        inlen -= 0x80
-
-    key = 0xFF if xorff else 0
-    if inlen >= 0x02: # 0x02-0x7F remainder
-        dout.extend(bytes([ ((inlen >> 1) - 1) * 4 + 3 ]))
-        for i in range((inlen >> 1) * 2):
-            dout.extend(bytes([ ord(f.read(1)) ^ key ]))
-        inlen -= (inlen >> 1) * 2
-
-    if inlen == 0x01: # pad with useless character
-        dout.extend(b'\x03')
-        dout.extend(bytes([ ord(f.read(1)) ^ key ]))
-        dout.extend(b'\x00')
-
-    return dout
+    if level not in (LEVEL_STORE, LEVEL_GREEDY, LEVEL_LAZY, LEVEL_OPTIMAL):
+        raise ValueError("unknown MZX compression level {0}".format(level))
+    literals = data
+    data = memoryview(data).cast('B')
+    inlen = len(data)
+    if inlen & 1:
+        literals = bytes(data) + b'\x00'  # pad with useless character
+        data = memoryview(literals)
+    words = data.cast('H')
+    if xorff:
+        # literal bytes are sliced from a copy with the key applied to the whole input at once
+        if not isinstance(literals, (bytes, bytearray)):
+            literals = bytes(data)
+        literals = memoryview(literals.translate(XORFF_TABLE))  # sliced without copies, like data
+    else:
+        literals = data
+    start = len(out)
+
+    if level == LEVEL_OPTIMAL:
+        out += _parse_optimal(data, words, literals, inlen, xorff).dout
+    elif level == LEVEL_LAZY:
+        out += _parse_shortest(data, words, literals, inlen, xorff).dout
+    else:
+        writer = _Mzx0Writer(data, words, literals, inlen, xorff, out)
+        if level == LEVEL_STORE:
+            writer.literal(0, len(words))
+        else:
+            _parse_lazy(writer, words, MAX_CHAIN[level], level == LEVEL_LAZY)
+        writer.close()
+    return len(out) - start
+
+
+class _Mzx0Writer:
+    """Appends commands to an MZX0 stream while tracking the decoder state."""
+
+    def __init__(self, data, words, literals, inlen, xorff, dout=None):
+        self.data = data
+        self.words = words
+        self.literals = literals  # input bytes as written by literal commands
+        self.init = 0xFFFF if xorff else 0
+        self.ring = [self.init] * RING_SIZE
+        self.ring_wpos = 0
+        self.reset_pos = 0  # word position where the decoder last reset clear_count
+        self.lit_pos = 0    # open literal run, emitted on the next command or close()
+        self.lit_len = 0
+        self.literal_mask = bytearray(len(words))
+        self.dout = bytearray() if dout is None else dout
+        self.dout += b'MZX0'
+        self.dout += pack('<L', inlen)
+
+    def last(self, pos):
+        """Word repeated by an RLE command starting at pos."""
+        if pos == 0 or pos - self.reset_pos >= CLEAR_COUNT:
+            return self.init
+        return self.words[pos - 1]
+
+    def boundary(self, pos):
+        if pos == 0 or pos - self.reset_pos >= CLEAR_COUNT:
+            self.reset_pos = pos
+
+    def ring_slot(self, word):
+        return self.ring.index(word) if word in self.ring else -1
+
+    def literal(self, pos, count=1):
+        if self.lit_len == 0:
+            self.lit_pos = pos
+        for split in range(pos + (-self.lit_len) % MAX_RUN, pos + count, MAX_RUN):
+            self.boundary(split)
+        self.lit_len += count
+        self.literal_mask[pos:pos + count] = b'\x01' * count
+        # only the last RING_SIZE words survive in the ring buffer
+        start = max(pos, pos + count - RING_SIZE)
+        ring_wpos = (self.ring_wpos + start - pos) % RING_SIZE
+        for word in self.words[start:pos + count]:
+            self.ring[ring_wpos] = word
+            ring_wpos = (ring_wpos + 1) % RING_SIZE
+        self.ring_wpos = ring_wpos
+
+    def flush_literal(self):
+        pos, remaining = self.lit_pos, self.lit_len
+        while remaining > 0:
+            count = min(remaining, MAX_RUN)
+            self.dout.append(((count - 1) << 2) | 3)
+            self.dout += self.literals[pos * 2:(pos + count) * 2]
+            pos += count
+            remaining -= count
+        self.lit_len = 0
+
+    def rle(self, pos, count):
+        self.flush_literal()
+        if self.words[pos] != self.last(pos):
+            # planned against the previous word, but the decoder resets here
+            self.backref(pos, count, 1)
+            return
+        self.boundary(pos)
+        self.dout.append(((count - 1) << 2) | 0)
+
+    def backref(self, pos, count, dist):
+        self.flush_literal()
+        self.boundary(pos)
+        self.dout.append(((count - 1) << 2) | 1)
+        self.dout.append(dist - 1)
+
+    def ring_hit(self, pos, slot):
+        self.flush_literal()
+        self.boundary(pos)
+        self.dout.append((slot << 2) | 2)
+
+    def close(self):
+        self.flush_literal()
+        return self.dout
+
+
+class _MatchFinder:
+    """Hash chains over 2-word keys, positions are inserted lazily up to the searched one."""
+
+    def __init__(self, data, words, max_chain):
+        self.data = data
+        self.words = words
+        self.max_chain = max_chain
+        self.head = {}
+        self.prev = [-1] * len(words)
+        self.inserted = 0
+
+    def longest(self, pos, limit):
+        """Return (length, distance) of the longest backreference for pos, or (0, 0)."""
+        words = self.words
+        head = self.head
+        prev = self.prev
+        nwords = len(words)
+        while self.inserted < pos:
+            i = self.inserted
+            if i + 1 < nwords:
+                k = (words[i] << 16) | words[i + 1]
+                prev[i] = head.get(k, -1)
+                head[k] = i
+            self.inserted = i + 1
+        if limit < MIN_MATCH:
+            return 0, 0
+
+        data = self.data
+        target = data[pos * 2:(pos + limit) * 2]
+        match_len = match_dist = 0
+        cand = head.get((words[pos] << 16) | words[pos + 1], -1)
+        chain = self.max_chain
+        while cand >= 0 and pos - cand <= MAX_DISTANCE and chain > 0:
+            if words[cand + match_len] == words[pos + match_len]:
+                if data[cand * 2:(cand + limit) * 2] == target:
+                    return limit, pos - cand
+                length = 2
+                while words[cand + length] == words[pos + length]:
+                    length += 1
+                if length > match_len:
+                    match_len = length
+                    match_dist = pos - cand
+            cand = prev[cand]
+            chain -= 1
+        return match_len, match_dist
+
+
+def _parse_lazy(writer, words, max_chain, lazy):
+    finder = _MatchFinder(writer.data, words, max_chain)
+    nwords = len(words)
+
+    def best_command(pos):
+        limit = min(MAX_RUN, nwords - pos)
+        last = writer.last(pos)
+        rle_len = 0
+        while rle_len < limit and words[pos + rle_len] == last:
+            rle_len += 1
+        match_len, match_dist = finder.longest(pos, limit)
+        if rle_len > 0 and rle_len >= match_len:
+            return rle_len, 0
+        return match_len, match_dist
+
+    pos = 0
+    while pos < nwords:
+        length, dist = best_command(pos)
+        if lazy and 0 < length < MAX_RUN and pos + 1 < nwords:
+            # a literal here is worth it when it and the next command cost fewer bytes per word:
+            # (word_cost + next_cost) / (1 + next_length) < cost / length
+            next_length, next_dist = best_command(pos + 1)
+            if next_length > length:
+                cost = 2 if dist else 1
+                next_cost = 2 if next_dist else 1
+                if writer.ring_slot(words[pos]) >= 0:
+                    word_cost = 1
+                elif writer.lit_len % MAX_RUN:
+                    word_cost = 2  # joins the open literal run
+                else:
+                    word_cost = 3
+                if (word_cost + next_cost) * length < cost * (1 + next_length):
+                    length = 0
+
+        if length and dist:
+            writer.backref(pos, length, dist)
+            pos += length
+        elif length:
+            writer.rle(pos, length)
+            pos += length
+        else:
+            slot = writer.ring_slot(words[pos])
+            if slot >= 0:
+                writer.ring_hit(pos, slot)
+            else:
+                writer.literal(pos)
+            pos += 1
+
+
+def _parse_shortest(data, words, literals, inlen, xorff):
+    """Lazy parse, or the level 1 greedy one when the deferrals (decided one command ahead) made the stream longer."""
+    best = None
+    for lazy in (True, False):
+        writer = _Mzx0Writer(data, words, literals, inlen, xorff)
+        _parse_lazy(writer, words, MAX_CHAIN[LEVEL_LAZY if lazy else LEVEL_GREEDY], lazy)
+        writer.close()
+        if best is None or len(writer.dout) < len(best.dout):
+            best = writer
+    return best
+
+
+def _ring_hits(words, init, literal_mask):
+    """Flag the words found in the ring buffer when the literals of a parse are replayed."""
+    ring = [init] * RING_SIZE
+    ring_wpos = 0
+    hits = bytearray(len(words))
+    for pos, word in enumerate(words):
+        if word in ring:
+            hits[pos] = 1
+        if literal_mask[pos]:
+            ring[ring_wpos] = word
+            ring_wpos = (ring_wpos + 1) % RING_SIZE
+    return hits
+
+
+def _parse_optimal(data, words, literals, inlen, xorff):
+    nwords = len(words)
+    best = _parse_shortest(data, words, literals, inlen, xorff)
+
+    finder = _MatchFinder(data, words, MAX_CHAIN[LEVEL_OPTIMAL])
+    match_len = [0] * nwords
+    match_dist = [0] * nwords
+    for pos in range(nwords):
+        match_len[pos], match_dist[pos] = finder.longest(pos, min(MAX_RUN, nwords - pos))
+
+    # run of identical words starting at each position, for RLE of the previous word
+    same_run = [1] * (nwords + 1)
+    for pos in range(nwords - 2, -1, -1):
+        if words[pos] == words[pos + 1]:
+            same_run[pos] = same_run[pos + 1] + 1
+
+    # the ring buffer depends on which words end up as literals, so each pass
+    # predicts its hits from the previous parse, the shortest stream is kept
+    previous = best
+    for _ in range(OPTIMAL_PASSES):
+        writer = _Mzx0Writer(data, words, literals, inlen, xorff)
+        ring_hits = _ring_hits(words, writer.init, previous.literal_mask)
+        _emit_optimal(writer, words, match_len, match_dist, same_run, ring_hits)
+        if len(writer.close()) < len(best.dout):
+            best = writer
+        previous = writer
+    return best
+
+
+def _emit_optimal(writer, words, match_len, match_dist, same_run, ring_hits):
+    """Shortest path over the command costs, then replay it through the writer."""
+    nwords = len(words)
+
+    # cost[pos] = bytes needed to encode words[pos:], lit_key[pos] = 2 * pos + cost[pos]
+    # so that a literal run pos..end costs 1 - 2 * pos + lit_key[end]
+    cost = [0] * (nwords + 1)
+    lit_key = [0] * (nwords + 1)
+    lit_key[nwords] = 2 * nwords
+    step = [0] * nwords     # words covered by the chosen command
+    kind = [0] * nwords     # command type
+    for pos in range(nwords - 1, -1, -1):
+        window = lit_key[pos + 1:pos + 1 + MAX_RUN]
+        best = min(window)
+        best_cost = 1 - 2 * pos + best
+        best_step = window.index(best) + 1
+        best_kind = 3
+
+        if ring_hits[pos] and 1 + cost[pos + 1] < best_cost:
+            best_cost = 1 + cost[pos + 1]
+            best_step = 1
+            best_kind = 2
+
+        prev_word = words[pos - 1] if pos else writer.init
+        if words[pos] == prev_word:
+            window = cost[pos + 1:pos + 1 + min(same_run[pos], MAX_RUN)]
+            best = min(window)
+            if 1 + best < best_cost:
+                best_cost = 1 + best
+                best_step = window.index(best) + 1
+                best_kind = 0
+
+        if match_len[pos] >= MIN_MATCH:
+            window = cost[pos + MIN_MATCH:pos + 1 + match_len[pos]]
+            best = min(window)
+            if 2 + best < best_cost:
+                best_cost = 2 + best
+                best_step = window.index(best) + MIN_MATCH
+                best_kind = 1
+
+        cost[pos] = best_cost
+        lit_key[pos] = 2 * pos + best_cost
+        step[pos] = best_step
+        kind[pos] = best_kind
+
+    pos = 0
+    while pos < nwords:
+        length = step[pos]
+        if kind[pos] == 0:
+            writer.rle(pos, length)
+        elif kind[pos] == 1:
+            writer.backref(pos, length, match_dist[pos])
+        elif length == 1 and writer.ring_slot(words[pos]) >= 0:
+            # predicted ring buffer hits are only used when the prediction holds
+            writer.ring_hit(pos, writer.ring_slot(words[pos]))
+        else:
+            writer.literal(pos, length)
+        pos += length
@@ -8,57 +8,216 @@
 # Copyright (c) 2018 <hintay@me.com>
 
 from io import BytesIO
+from . import XORFF_TABLE
 
 
 def mzx0_decompress(f, inlen, exlen, xorff=False) -> [str, BytesIO]:
     """
     Decompress a block of data.
     """
-    key = 0xFF
+    status, out_data = mzx0_decode(f.read(inlen), exlen, xorff)
+    return [status, BytesIO(out_data)]
 
-    out_data = BytesIO()  # slightly overprovision for writes past end of buffer
-    ring_buf = [b'\xFF\xFF'] * 64 if xorff else [b'\x00\x00'] * 64
+
+def mzx0_decode(data, exlen, xorff=False) -> [str, bytearray]:
+    """
+    Decompress a bytes-like datablock (MZX0 header excluded) into a bytearray of exlen bytes.
+    """
+    init = b'\xFF\xFF' if xorff else b'\x00\x00'
+
+    out_data = bytearray(exlen + 0x80)  # slightly overprovision for writes past end of buffer
+    # the ring buffer and the last word are kept as offsets into out_data, -1 stands for init
+    ring_buf = [-1] * 64
     ring_wpos = 0
+    last = -1
 
     clear_count = 0
-    max = f.tell() + inlen
-    last = b'\xFF\xFF' if xorff else b'\x00\x00'
+    inlen = len(data)
+    ipos = opos = 0
+    # literal bytes are sliced from a copy with the key applied to the whole input at once,
+    # through a memoryview so both keys slice without copies
+    literals = memoryview(bytes(data).translate(XORFF_TABLE) if xorff else data)
 
-    while out_data.tell() < exlen:
-        if f.tell() >= max:
+    while opos < exlen:
+        if ipos >= inlen:
             break
         if clear_count <= 0:
             clear_count = 0x1000
-            last = b'\xFF\xFF' if xorff else b'\x00\x00'
-        flags = ord(f.read(1))
-        # print("+ %X %X %X" % (flags, f.tell(), out_data.tell()))
-
-        clear_count -= 1 if (flags & 0x03) == 2 else flags // 4 + 1
+            last = -1
+        flags = data[ipos]
+        ipos += 1
+        cmd = flags & 0x03
+        count = (flags >> 2) + 1
+        size = count * 2
 
-        if flags & 0x03 == 0:
-            out_data.write(last * ((flags // 4) + 1))
+        if cmd == 0:
+            out_data[opos:opos + size] = (init if last < 0 else out_data[last:last + 2]) * count
+            opos += size
+            clear_count -= count
 
-        elif flags & 0x03 == 1:
-            k = 2 * (ord(f.read(1)) + 1)
-            for i in range(flags // 4 + 1):
-                out_data.seek(-k, 1)
-                last = out_data.read(2)
-                out_data.seek(0, 2)
-                out_data.write(last)
+        elif cmd == 1:
+            k = 2 * (data[ipos] + 1)
+            ipos += 1
+            src = opos - k
+            if src < 0:  # clamped to the start of output, as BytesIO.seek did, word by word
+                for i in range(count):
+                    src = max(0, opos - k)
+                    word = out_data[src:min(src + 2, opos)]
+                    out_data[opos:opos + len(word)] = word
+                    opos += len(word)
+            elif k >= size:
+                out_data[opos:opos + size] = out_data[src:src + size]
+                opos += size
+            else:  # overlapping copy repeats the last k bytes
+                out_data[opos:opos + size] = (out_data[src:opos] * (size // k + 1))[:size]
+                opos += size
+            last = opos - 2
+            clear_count -= count
 
-        elif flags & 0x03 == 2:
-            last = ring_buf[flags // 4]
-            out_data.write(last)
+        elif cmd == 2:
+            last = ring_buf[flags >> 2]
+            out_data[opos:opos + 2] = init if last < 0 else out_data[last:last + 2]
+            opos += 2
+            clear_count -= 1
 
         else:
-            for i in range(flags // 4 + 1):
-                last = ring_buf[ring_wpos] = bytes([byte ^ key for byte in f.read(2)]) if xorff else f.read(2)
-                out_data.write(last)
+            chunk = literals[ipos:ipos + size]
+            ipos += size
+            size = len(chunk)  # short on a truncated stream
+            out_data[opos:opos + size] = chunk
+
+            count = size >> 1
+            head = min(count, 64 - ring_wpos)
+            ring_buf[ring_wpos:ring_wpos + head] = range(opos, opos + head * 2, 2)
+            if count > head:
+                ring_buf[:count - head] = range(opos + head * 2, opos + size, 2)
+            ring_wpos = (ring_wpos + count) % 64
 
-                ring_wpos += 1
-                ring_wpos %= 64
+            opos += size
+            last = opos - 2
+            clear_count -= (flags >> 2) + 1
     status = "OK"
 
-    out_data.truncate(exlen)  # Resize stream to decompress size
-    out_data.seek(0)
+    del out_data[min(opos, exlen):]  # Resize buffer to decompress size
     return [status, out_data]
+
+
+class Mzx0Decompressor:
+    """
+    Incremental decompressor, only the last 0x200 bytes of output (the backreference window)
+    and the ring buffer are kept between calls.
+    """
+    WINDOW_SIZE = 0x200
+
+    def __init__(self, exlen, xorff=False):
+        self.exlen = exlen
+        self.xorff = xorff
+        self.eof = exlen <= 0
+        self.total_out = 0
+        self.init = b'\xFF\xFF' if xorff else b'\x00\x00'
+        self.unconsumed = b''
+        self.window = bytearray()
+        self.ring_buf = [self.init] * 64
+        self.ring_wpos = 0
+        self.last = self.init
+        self.clear_count = 0
+
+    def decompress(self, data, final=False) -> bytes:
+        """
+        Feed input, return the output of every complete command. Incomplete trailing commands are
+        kept for the next call unless final is set, in which case they are decoded as far as possible.
+        """
+        data = self.unconsumed + data if self.unconsumed else data
+        inlen = len(data)
+        ipos = 0
+        out_data = self.window
+        start = len(out_data)
+        limit = start + self.exlen - self.total_out
+        ring_buf = self.ring_buf
+        ring_wpos = self.ring_wpos
+        last = self.last
+        clear_count = self.clear_count
+
+        while len(out_data) < limit:
+            if ipos >= inlen:
+                break
+            flags = data[ipos]
+            cmd = flags & 0x03
+            count = (flags >> 2) + 1
+            size = count * 2
+            need = 1 + size if cmd == 3 else 2 if cmd == 1 else 1
+            if ipos + need > inlen and not (final and cmd != 1):
+                break
+            ipos += 1
+            if clear_count <= 0:
+                clear_count = 0x1000
+                last = self.init
+
+            if cmd == 0:
+                out_data += last * count
+                clear_count -= count
+
+            elif cmd == 1:
+                k = 2 * (data[ipos] + 1)
+                ipos += 1
+                src = len(out_data) - k
+                if src < 0:  # clamped to the start of output, as BytesIO.seek did, word by word
+                    for i in range(count):
+                        src = max(0, len(out_data) - k)
+                        out_data += out_data[src:src + 2]
+                elif k >= size:
+                    out_data += out_data[src:src + size]
+                else:  # overlapping copy repeats the last k bytes
+                    out_data += (out_data[src:] * (size // k + 1))[:size]
+                last = bytes(out_data[-2:])
+                clear_count -= count
+
+            elif cmd == 2:
+                last = ring_buf[flags >> 2]
+                out_data += last
+                clear_count -= 1
+
+            else:
+                chunk = bytes(data[ipos:ipos + size])
+                ipos += size
+                if self.xorff:
+                    chunk = bytes(chunk).translate(XORFF_TABLE)
+                out_data += chunk
+                for i in range(0, len(chunk), 2):
+                    last = ring_buf[ring_wpos] = chunk[i:i + 2]
+                    ring_wpos = (ring_wpos + 1) % 64
+                clear_count -= count
+
+        self.unconsumed = bytes(data[ipos:])
+        self.ring_wpos = ring_wpos
+        self.last = last
+        self.clear_count = clear_count
+
+        result = bytes(out_data[start:limit])
+        self.total_out += len(result)
+        if self.total_out >= self.exlen or (final and not self.unconsumed):
+            self.eof = True
+        del out_data[:max(0, len(out_data) - self.WINDOW_SIZE)]
+        return result
+
+
+def mzx0_decompress_iter(f, inlen, exlen, xorff=False, chunk_size=0x10000):
+    """
+    Decompress a block of data, yielding chunk_size bytes at a time (the last chunk may be shorter).
+    """
+    decompressor = Mzx0Decompressor(exlen, xorff)
+    read_size = max(chunk_size // 0x80, 0x100)  # one input byte expands to at most 0x80 bytes
+    pending = bytearray()
+    while inlen > 0 and not decompressor.eof:
+        block = f.read(min(read_size, inlen))
+        if not block:
+            break
+        inlen -= len(block)
+        pending += decompressor.decompress(block, final=inlen <= 0)
+        while len(pending) >= chunk_size:
+            yield bytes(pending[:chunk_size])
+            del pending[:chunk_size]
+    if not decompressor.eof:
+        pending += decompressor.decompress(b'', final=True)
+    if pending:
+        yield bytes(pending)
@@ -4,13 +4,12 @@
 comes with ABSOLUTELY NO WARRANTY.
 """
 
-import shutil
 from pathlib import Path
 from sys import stderr
 from struct import unpack
 import re
 import argparse
-from mzx.decomp_mzx0 import mzx0_decompress
+from mzx.decomp_mzx0 import mzx0_decompress_iter
 
 
 raw_script_path = Path("10rawscript")
@@ -33,24 +32,24 @@ def process_path(source_path: Path):
     out_tpl = base_stem + '.tpl.txt'
     with source_path.open('rb') as data:
         sig, size = unpack('<LL', data.read(0x8))
-        status, decbuf = mzx0_decompress(data, source_path.stat().st_size - 8, size, xorff=True)
-        if status != "OK":
-            print("[{0}] {1}".format(status, source_path), file=stderr)
-        with raw_script_path.joinpath(out_txt).open('wb') as dbg:
-            shutil.copyfileobj(decbuf, dbg)
 
+        # decoded chunks go straight to disk, only the unfinished instruction is carried over
         outcoll = []
-        decbuf.seek(0)
-        for index, instr in enumerate(decbuf.read().split(b';')):
-            instrtext = instr.decode('cp932', 'surrogateescape')
-            if re.search(r'_LVSV|_STTI|_MSAD|_ZM|SEL[R]', instrtext) is not None:
-                outcoll.append(
-                    "<{0:04d}>".format(index) + instrtext.replace("^", "_r")
-                    .replace("@n", "_n").replace(",", ";/"))  # replace order significant
-            elif len(re.sub('[ -~]', '', instrtext)) > 0:
-                outcoll.append(u"!" + instrtext)  # flag missing matches containing non-ASCII characters
-            else:
-                outcoll.append(u"~" + instrtext + u"~")  # non-localizable
+        tail = b''
+        decoded = 0
+        with raw_script_path.joinpath(out_txt).open('wb') as dbg:
+            for chunk in mzx0_decompress_iter(data, source_path.stat().st_size - 8, size, xorff=True):
+                dbg.write(chunk)
+                decoded += len(chunk)
+                instrs = (tail + chunk).split(b';')
+                tail = instrs.pop()
+                for instr in instrs:
+                    outcoll.append(process_instruction(len(outcoll), instr))
+        outcoll.append(process_instruction(len(outcoll), tail))
+        # the streaming decoder stops at the end of the input, a short output means a truncated stream
+        status = "OK" if decoded == size else "truncated, {0} of {1} b decoded".format(decoded, size)
+        if status != "OK":
+            print("[{0}] {1}".format(status, source_path), file=stderr)
 
         if outcoll:
             with decoded_script_path.joinpath(out_tpl).open('wt', encoding="cp932", errors='surrogateescape') as outfile:
@@ -58,6 +57,17 @@ def process_path(source_path: Path):
     return status
 
 
+def process_instruction(index, instr):
+    instrtext = instr.decode('cp932', 'surrogateescape')
+    if re.search(r'_LVSV|_STTI|_MSAD|_ZM|SEL[R]', instrtext) is not None:
+        return "<{0:04d}>".format(index) + instrtext.replace("^", "_r") \
+            .replace("@n", "_n").replace(",", ";/")  # replace order significant
+    elif len(re.sub('[ -~]', '', instrtext)) > 0:
+        return u"!" + instrtext  # flag missing matches containing non-ASCII characters
+    else:
+        return u"~" + instrtext + u"~"  # non-localizable
+
+
 """
 debugging:
     try: